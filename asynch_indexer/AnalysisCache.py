@@ -0,0 +1,96 @@
+import hashlib
+import json
+import sqlite3
+import time
+import zlib
+
+# Number of cache hits whose access time is kept in memory before being written
+ACCESS_FLUSH_SIZE = 100
+
+class AnalysisCache:
+    def __init__(self, cache_path, max_entries=100_000):
+        # Persistent store of Document Intelligence results keyed by a hash of the model id and
+        # the document bytes, so that re-processing a document does not pay for its analysis again
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS analyses ("
+            "key TEXT PRIMARY KEY, result BLOB NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS analyses_last_access ON analyses (last_access)"
+        )
+        self.connection.commit()
+
+        # Access times of the hits not written yet, the lookups themselves do not write
+        self.accessed = {}
+
+        # Hit/miss counters for the current process
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model_id, pdf_path):
+        # The document is hashed from its file, one block at a time
+        digest = hashlib.sha256(model_id.encode('utf-8'))
+        digest.update(b"\0")
+        with open(pdf_path, "rb") as pdf_file:
+            for block in iter(lambda: pdf_file.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def get(self, key):
+        # Return the serialized result (the REST representation, as a dict) or None
+        row = self.connection.execute(
+            "SELECT result FROM analyses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        # Refresh the access time so eviction is least-recently-used, in batches
+        self.accessed[key] = time.time()
+        if len(self.accessed) >= ACCESS_FLUSH_SIZE:
+            self.write_access_times()
+            self.connection.commit()
+        return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+    def put(self, key, result):
+        # Results are mostly repeated JSON keys and text, they compress well
+        self.connection.execute(
+            "INSERT OR REPLACE INTO analyses (key, result, last_access) VALUES (?, ?, ?)",
+            (key, zlib.compress(json.dumps(result).encode('utf-8')), time.time())
+        )
+        self.write_access_times()
+        # Drop the least recently used results once the cache grows beyond max_entries
+        count = self.connection.execute("SELECT COUNT(*) FROM analyses").fetchone()[0]
+        if count > self.max_entries:
+            self.connection.execute(
+                "DELETE FROM analyses WHERE key IN ("
+                "SELECT key FROM analyses ORDER BY last_access LIMIT ?)",
+                (count - self.max_entries,)
+            )
+        self.connection.commit()
+
+    def write_access_times(self):
+        if self.accessed:
+            self.connection.executemany(
+                "UPDATE analyses SET last_access = ? WHERE key = ?",
+                [(now, key) for key, now in self.accessed.items()]
+            )
+            self.accessed = {}
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        self.write_access_times()
+        self.connection.commit()
+        self.connection.close()
@@ -10,13 +10,56 @@ from .Chunker import Chunker
 from .TextEmbedder import TextEmbedder  
 from .ImageEmbedder import ImageEmbedder  
 from .FileUploader import FileUploader  
+from .EmbeddingCache import EmbeddingCache  
+from .AnalysisCache import AnalysisCache  
+from .IndexManifest import IndexManifest  
+from .IndexingJournal import IndexingJournal  
+from .ConcurrencyController import ConcurrencyController  
+from .DownloadBudget import DownloadBudget  
+from .Deduplicator import Deduplicator  
+from .PipelineMetrics import PipelineMetrics  
+  
+# Default maximum size of each stage queue, bounding the memory held between stages  
+DEFAULT_QUEUE_SIZES = {  
+    "file": 100,  
+    "text": 100,  
+    "image": 100,  
+    "chunk": 1000,  
+    "vector": 2000,  
+}  
+  
+# Default number of workers of each stage  
+DEFAULT_NUM_WORKERS = {  
+    "read": 3,  
+    "chunk": 2,  
+    "text_embed": 3,  
+    "image_embed": 3,  
+    "upload": 3,  
+}  
+  
+# Upper bound on the workers of the service-bound stages when adaptive concurrency is enabled  
+DEFAULT_MAX_NUM_WORKERS = {  
+    "read": 12,  
+    "text_embed": 12,  
+    "image_embed": 12,  
+    "upload": 12,  
+}  
   
 class AsynchronousIndexer:  
     def __init__(self, index_name, search_endpoint, search_api_key,  
                  storage_account_name, storage_container_name,  
                  ai_foundry_endpoint, ai_foundry_key, 
                  text_embedding_model, image_embedding_model, 
-                 document_intelligence_endpoint, document_intelligence_key):  
+                 document_intelligence_endpoint, document_intelligence_key,
+                 embedding_cache_path=None, manifest_path=None, cpu_workers=None,  
+                 queue_sizes=None, num_workers=None, adaptive_concurrency=False,  
+                 max_num_workers=None, target_latencies=None,  
+                 metrics_summary_path=None, prometheus_path=None, queue_sample_interval=1.0,  
+                 journal_path=None, analysis_cache_path=None, pages_per_request=None,  
+                 max_in_flight_bytes=512 * 1024 * 1024, deduplication=None,  
+                 text_similarity=0.9, image_similarity=0.9,  
+                 text_vector_processor=None, image_vector_processor=None,  
+                 reader_registry=None, office_extraction="document_intelligence"):  
   
         # Initialize the Azure Blob Storage client  
         self.storage_account_url = f"https://{storage_account_name}.blob.core.windows.net"  
@@ -28,86 +71,251 @@ class AsynchronousIndexer:
         )  
         self.storage_container_client = self.blob_service_client.get_container_client(self.storage_container_name)  
   
+        # Journal of the progress of the run, an interrupted run resumes from it when a path is given.  
+        # It owns the vectors it stores when it doubles as the embedding cache  
+        self.journal = IndexingJournal(journal_path, owns_embeddings=not embedding_cache_path) if journal_path else None  
+  
+        # Persistent embedding cache shared by both embedders, disabled when no path is given.  
+        # A resumable run keeps its vectors in the journal file when no other cache is configured,  
+        # they are cleared with the journal at the end of a complete run  
+        embedding_cache_path = embedding_cache_path or journal_path  
+        self.embedding_cache = EmbeddingCache(embedding_cache_path) if embedding_cache_path else None  
+  
+        # Persistent cache of Document Intelligence results, disabled when no path is given  
+        self.analysis_cache = AnalysisCache(analysis_cache_path) if analysis_cache_path else None  
+  
+        # Manifest of previously indexed blobs, enables incremental indexing when a path is given  
+        self.manifest = IndexManifest(manifest_path) if manifest_path else None  
+  
+        # Worker counts per stage. With adaptive concurrency the service-bound stages start  
+        # max_num_workers workers, and an AIMD controller decides how many of them may call  
+        # the service at once, starting from num_workers  
+        self.num_workers = {**DEFAULT_NUM_WORKERS, **(num_workers or {})}  
+        self.limiters = {}  
+        if adaptive_concurrency:  
+            max_num_workers = {**DEFAULT_MAX_NUM_WORKERS, **(max_num_workers or {})}  
+            target_latencies = target_latencies or {}  
+            for stage, max_workers in max_num_workers.items():  
+                self.limiters[stage] = ConcurrencyController(  
+                    initial_limit=self.num_workers[stage],  
+                    max_limit=max_workers,  
+                    adaptive=True,  
+                    target_latency=target_latencies.get(stage)  
+                )  
+                self.num_workers[stage] = max_workers  
+  
+        # Bytes of the documents being read, shared by all reader workers  
+        self.download_budget = DownloadBudget(max_in_flight_bytes)  
+  
+        # Near-duplicate chunks and figures are skipped or linked to their first occurrence  
+        # when deduplication is "skip" or "link", disabled by default. Incremental runs only  
+        # reprocess changed blobs, so duplicates are then only searched within each blob: a  
+        # canonical entry in another blob could change or disappear while its copies are unchanged  
+        self.deduplicator = Deduplicator(  
+            mode=deduplication, text_similarity=text_similarity, image_similarity=image_similarity,  
+            per_blob=manifest_path is not None  
+        ) if deduplication else None  
+  
+        # Metrics shared by all stages, exported at the end of the run when a path is given  
+        self.metrics = PipelineMetrics()  
+        self.metrics_summary_path = metrics_summary_path  
+        self.prometheus_path = prometheus_path  
+        self.queue_sample_interval = queue_sample_interval  
+  
         # Initialize pipeline components  
-        self.file_reader = FileReader(document_intelligence_endpoint, document_intelligence_key)  
-        self.chunker = Chunker()  
-        self.text_embedder = TextEmbedder(ai_foundry_endpoint, ai_foundry_key, text_embedding_model)  
-        self.image_embedder = ImageEmbedder(ai_foundry_endpoint, ai_foundry_key,image_embedding_model)  
-        self.file_uploader = FileUploader(search_endpoint, index_name, search_api_key)  
+        self.file_reader = FileReader(  
+            document_intelligence_endpoint, document_intelligence_key,  
+            cpu_workers=cpu_workers, limiter=self.limiters.get("read"), metrics=self.metrics,  
+            journal=self.journal, analysis_cache=self.analysis_cache, pages_per_request=pages_per_request,  
+            download_budget=self.download_budget, deduplicator=self.deduplicator,  
+            registry=reader_registry, office_extraction=office_extraction, manifest=self.manifest  
+        )  
+        self.chunker = Chunker(
+            metrics=self.metrics, journal=self.journal, deduplicator=self.deduplicator, manifest=self.manifest
+        )  
+        self.text_embedder = TextEmbedder(  
+            ai_foundry_endpoint, ai_foundry_key, text_embedding_model,  
+            cache=self.embedding_cache, limiter=self.limiters.get("text_embed"), metrics=self.metrics,  
+            journal=self.journal, vector_processor=text_vector_processor  
+        )  
+        self.image_embedder = ImageEmbedder(  
+            ai_foundry_endpoint, ai_foundry_key,image_embedding_model,  
+            cache=self.embedding_cache, limiter=self.limiters.get("image_embed"), metrics=self.metrics,  
+            journal=self.journal, vector_processor=image_vector_processor  
+        )  
+        self.file_uploader = FileUploader(  
+            search_endpoint, index_name, search_api_key,  
+            on_uploaded=self.record_uploaded, max_concurrent_batches=self.num_workers["upload"],  
+            limiter=self.limiters.get("upload"), metrics=self.metrics  
+        )  
   
         # Set up logging  
         self.logger = logging.getLogger(__name__)  
   
-        # Initialize queues  
-        self.file_queue = asyncio.Queue()  
-        self.text_queue = asyncio.Queue()  
-        self.image_queue = asyncio.Queue()  
-        self.chunk_queue = asyncio.Queue()  
-        self.vector_queue = asyncio.Queue()  
+        # Initialize bounded queues, a full queue makes the upstream stage wait (backpressure)  
+        queue_sizes = {**DEFAULT_QUEUE_SIZES, **(queue_sizes or {})}  
+        self.file_queue = asyncio.Queue(maxsize=queue_sizes["file"])  
+        self.text_queue = asyncio.Queue(maxsize=queue_sizes["text"])  
+        self.image_queue = asyncio.Queue(maxsize=queue_sizes["image"])  
+        self.chunk_queue = asyncio.Queue(maxsize=queue_sizes["chunk"])  
+        self.vector_queue = asyncio.Queue(maxsize=queue_sizes["vector"])  
   
-    async def run_indexing(self):  
-        start_time = time.time()  
-        blob_list = self.storage_container_client.list_blobs()  
+    def record_uploaded(self, document):  
+        # Called by the uploader for every document accepted by the index  
+        if self.manifest is not None:  
+            self.manifest.record_chunk(document)  
+        if self.journal is not None:  
+            self.journal.record_uploaded(document)  
   
-        # Populate the file queue with blobs  
-        async for blob in blob_list:  
-            if blob.name.endswith('.pdf'):  
+    async def produce_blobs(self, listed_blob_names):  
+        # Stream the container listing page by page into the file queue while the workers run  
+        enqueued = 0  
+        async for blob in self.storage_container_client.list_blobs():  
+            # Only the formats with a registered reader are indexed  
+            if self.file_reader.registry.get(blob) is not None:  
+                # Skip the unchanged blobs in incremental mode. Only the manifest needs the names  
+                # of the listed blobs, to find the removed ones  
+                if self.manifest is not None:  
+                    listed_blob_names.add(blob.name)  
+                    if not self.manifest.has_changed(blob):  
+                        continue  
+                    self.manifest.mark_pending(blob)  
+                # Skip the blobs already uploaded by an interrupted run. The manifest records them  
+                # from the ids the journal kept, blobs whose ids are unknown are indexed again  
+                if self.journal is not None and self.journal.get_stage(blob) == "uploaded":  
+                    if self.manifest is None:  
+                        continue  
+                    chunk_ids = self.journal.get_uploaded_chunk_ids(blob)  
+                    if chunk_ids is not None:  
+                        self.manifest.record_uploaded_blob(blob.name, chunk_ids)  
+                        continue  
                 await self.file_queue.put(blob)  
+                enqueued += 1  
+  
+        if self.manifest is not None:  
+            self.logger.info(f"Incremental indexing: {enqueued} of {len(listed_blob_names)} blobs are new or changed")  
+  
+    async def close(self):  
+        # Release the stores and clients of the run, also when it failed  
+        if self.manifest is not None:  
+            self.manifest.close()  
+  
+        # Forget the journal once every document made it to the index, so the next run starts afresh  
+        if self.journal is not None:  
+            self.logger.info(f"Indexing journal: {self.journal.stats()}")  
+            if self.journal.is_complete():  
+                self.journal.clear()  
+            self.journal.close()  
   
-        # Number of workers for each task  
-        num_workers = 3  
+        # Close the uploader, the embedding clients and the reader's process pool  
+        await self.file_uploader.close()  
+        await self.text_embedder.close()  
+        await self.image_embedder.close()  
+        await self.file_reader.close()  
+        if self.embedding_cache is not None:  
+            self.embedding_cache.close()  
+        if self.analysis_cache is not None:  
+            self.analysis_cache.close()  
+  
+    @staticmethod  
+    async def stop_workers(queue, tasks):  
+        # One sentinel per worker, then wait for the stage to drain and exit  
+        for _ in tasks:  
+            await queue.put(None)  
+        await asyncio.gather(*tasks)  
+  
+    async def run_indexing(self):  
+        start_time = time.time()  
+        listed_blob_names = set()  
   
         # Create worker tasks  
         read_tasks = [  
-            asyncio.create_task(self.file_reader.read_pdf(  
+            asyncio.create_task(self.file_reader.read_files(  
                 self.storage_container_client, self.file_queue, self.text_queue, self.image_queue, f"read_worker_{i}", self.logger))  
-            for i in range(num_workers)  
+            for i in range(self.num_workers["read"])  
         ]  
         chunk_tasks = [  
             asyncio.create_task(self.chunker.chunk_text(  
                 self.text_queue, self.chunk_queue, f"chunk_worker_{i}", self.logger))  
-            for i in range(num_workers)  
+            for i in range(self.num_workers["chunk"])  
         ]  
         text_embedding_tasks = [  
             asyncio.create_task(self.text_embedder.vectorize_chunks(  
                 self.chunk_queue, self.vector_queue, f"text_embedder_{i}", self.logger))  
-            for i in range(num_workers)  
+            for i in range(self.num_workers["text_embed"])  
         ]  
         image_embedding_tasks = [  
             asyncio.create_task(self.image_embedder.embed_images(  
                 self.image_queue, self.vector_queue, f"image_embedder_{i}", self.logger))  
-            for i in range(num_workers)  
+            for i in range(self.num_workers["image_embed"])  
         ]  
         upload_tasks = [  
             asyncio.create_task(self.file_uploader.upload_documents(  
                 self.vector_queue, f"uploader_{i}", self.logger))  
-            for i in range(num_workers)  
+            for i in range(self.num_workers["upload"])  
         ]  
   
-        # Wait for all tasks to complete  
-        await self.file_queue.join()  
-        await self.text_queue.join()  
-        await self.chunk_queue.join()  
-        await self.image_queue.join()  
-        await self.vector_queue.join()  
-  
-        # Add sentinels to stop workers  
-        for _ in range(num_workers):  
-            await self.file_queue.put(None)  
-            await self.text_queue.put(None)  
-            await self.chunk_queue.put(None)  
-            await self.image_queue.put(None)  
-            await self.vector_queue.put(None)  
-  
-        # Wait for worker tasks to finish  
-        await asyncio.gather(*read_tasks)  
-        await asyncio.gather(*chunk_tasks)  
-        await asyncio.gather(*text_embedding_tasks)  
-        await asyncio.gather(*image_embedding_tasks)  
-        await asyncio.gather(*upload_tasks)  
-  
-        # Close the uploader  
-        await self.file_uploader.close()  
+        for stage, count in self.num_workers.items():  
+            self.metrics.set_workers(stage, count)  
+  
+        # Sample the queue depths while the pipeline runs  
+        queues = {  
+            "file": self.file_queue,  
+            "text": self.text_queue,  
+            "image": self.image_queue,  
+            "chunk": self.chunk_queue,  
+            "vector": self.vector_queue,  
+        }  
+        sampler_task = asyncio.create_task(  
+            self.metrics.sample_queues_periodically(queues, self.queue_sample_interval))  
+  
+        try:  
+            # Feed the readers while they are already running  
+            await self.produce_blobs(listed_blob_names)  
+  
+            # Stop the stages in pipeline order: a stage's sentinels are queued behind all of  
+            # its remaining items, and only once its producers have exited  
+            await self.stop_workers(self.file_queue, read_tasks)  
+            await self.stop_workers(self.text_queue, chunk_tasks)  
+            await self.stop_workers(self.chunk_queue, text_embedding_tasks)  
+            await self.stop_workers(self.image_queue, image_embedding_tasks)  
+            await self.stop_workers(self.vector_queue, upload_tasks)  
+  
+            # Delete the documents of removed blobs and the trailing chunks of shrunk ones. The  
+            # manifest keeps their ids until the index confirmed the deletion, failed ones are  
+            # retried by the next run  
+            if self.manifest is not None:  
+                stale_chunk_ids = self.manifest.finish_run(listed_blob_names)  
+                if stale_chunk_ids:  
+                    deleted = await self.file_uploader.delete_documents(stale_chunk_ids, self.logger)  
+                    self.manifest.record_deleted(deleted)  
+        finally:  
+            # Workers are still running only when the run failed  
+            sampler_task.cancel()  
+            for task in read_tasks + chunk_tasks + text_embedding_tasks + image_embedding_tasks + upload_tasks:  
+                task.cancel()  
+            await self.close()  
+  
+        # Export the end-of-run metrics  
+        extra = {"upload": self.file_uploader.stats()}  
+        extra["concurrency"] = {stage: limiter.stats() for stage, limiter in self.limiters.items()}  
+        extra["download_budget"] = self.download_budget.stats()  
+        if self.deduplicator is not None:  
+            extra["deduplication"] = self.deduplicator.stats()  
+            self.logger.info(f"Deduplication: {extra['deduplication']}")  
+        if self.embedding_cache is not None:  
+            extra["embedding_cache"] = self.embedding_cache.stats()  
+        if self.analysis_cache is not None:  
+            extra["analysis_cache"] = self.analysis_cache.stats()  
+  
+        summary = self.metrics.summary(extra)  
+        for stage, stage_summary in summary["stages"].items():  
+            self.logger.info(f"Stage {stage}: {stage_summary['items']} items, {stage_summary['items_per_second']:.2f} items/s, p50 {stage_summary['p50_latency']}s, p99 {stage_summary['p99_latency']}s, {stage_summary['errors']} errors")  
+        self.logger.info(f"Upload throughput: {extra['upload']}")  
+        if self.metrics_summary_path:  
+            self.metrics.write_summary(self.metrics_summary_path, extra)  
+        if self.prometheus_path:  
+            self.metrics.write_prometheus(self.prometheus_path)  
   
         total_time = time.time() - start_time  
         self.logger.info(f"Total indexing time: {total_time:.2f} seconds")  
\ No newline at end of file
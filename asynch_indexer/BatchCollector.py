@@ -0,0 +1,50 @@
+import asyncio
+
+
+class BatchCollector:
+    def __init__(self, max_items, max_cost, max_wait, cost_function):
+        # A batch is flushed as soon as it holds max_items, its cost reaches max_cost
+        # or max_wait seconds have passed since its first item was received
+        self.max_items = max_items
+        self.max_cost = max_cost
+        self.max_wait = max_wait
+        self.cost_function = cost_function
+
+    async def collect(self, queue, pending):
+        # Collect items until one of the flush conditions is met.
+        # Returns the batch, an item carried over to the next batch and whether a sentinel was seen.
+        loop = asyncio.get_running_loop()
+        batch = []
+        batch_cost = 0
+
+        if pending is None:
+            pending = await queue.get()
+            if pending is None:  # Sentinel to end the loop
+                queue.task_done()
+                return batch, None, True
+
+        deadline = loop.time() + self.max_wait
+        while True:
+            item, pending = pending, None
+            cost = self.cost_function(item)
+            if batch and batch_cost + cost > self.max_cost:
+                # Keep the item for the next batch rather than exceeding the budget
+                return batch, item, False
+            batch.append(item)
+            batch_cost += cost
+
+            if len(batch) >= self.max_items or batch_cost >= self.max_cost:
+                return batch, None, False
+
+            remaining = deadline - loop.time()
+            try:
+                if queue.empty() and remaining > 0:
+                    pending = await asyncio.wait_for(queue.get(), timeout=remaining)
+                else:
+                    pending = queue.get_nowait()
+            except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                return batch, None, False
+
+            if pending is None:  # Sentinel to end the loop once this batch is flushed
+                queue.task_done()
+                return batch, None, True
@@ -1,33 +1,174 @@
-from langchain.text_splitter import RecursiveCharacterTextSplitter  
-import time  
-  
-class Chunker:  
-    def __init__(self, chunk_size=2000, chunk_overlap=500):  
-        self.chunk_size = chunk_size  
-        self.chunk_overlap = chunk_overlap  
-  
-    async def chunk_text(self, text_queue, chunk_queue, worker_id, logger):  
-        while True:  
-            data = await text_queue.get()  
-            if data is None:  # Sentinel to end the loop  
-                text_queue.task_done()  
-                break  
-  
-            blob_name, blob_uri, text, parent_id, page_number = data  
-            logger.info(f"Chunker {worker_id}: Chunking document {blob_name} page {page_number}")  
-  
-            start_time = time.time()  
-            splitter = RecursiveCharacterTextSplitter(  
-                chunk_size=self.chunk_size,  
-                chunk_overlap=self.chunk_overlap,  
-                length_function=len  
-            )  
-            chunks = splitter.split_text(text)  
-            chunk_time = time.time() - start_time  
-            logger.info(f"Chunker {worker_id}: Finished chunking in {chunk_time:.2f} seconds")  
-  
-            # Put each chunk into the chunk queue  
-            for chunk in chunks:  
-                await chunk_queue.put((blob_name, blob_uri, chunk, parent_id, page_number))  
-  
-            text_queue.task_done()  
\ No newline at end of file
+import asyncio
+import logging
+import re
+import time
+from functools import lru_cache
+from .IndexManifest import IndexManifest
+from .PipelineMetrics import PipelineMetrics
+
+# Paragraph roles repeated on every page, they carry no content of their own
+SKIPPED_ROLES = {"pageHeader", "pageFooter", "pageNumber"}
+
+# Paragraph roles that open a new chunk once the current one is reasonably filled
+HEADING_ROLES = {"title", "sectionHeading"}
+
+# (pattern, joiner) used to cut a paragraph longer than a chunk, coarsest first
+SEPARATORS = (("\n", "\n"), (r"(?<=[.!?])\s+", " "), (r"\s+", " "))
+
+class Chunker:
+    def __init__(self, chunk_size=512, chunk_overlap=0, min_heading_fill=0.5,
+                 encoding_name="cl100k_base", metrics=None, journal=None, deduplicator=None,
+                 manifest=None):
+        # Sizes are in tokens of encoding_name. Chunks are packed from whole paragraphs across page
+        # boundaries, a heading starts a new chunk once the current one holds min_heading_fill
+        # of chunk_size, and chunk_overlap tokens of trailing paragraphs are repeated when a
+        # chunk is cut for size. cl100k_base is an OpenAI encoding, not the tokenizer of the
+        # Cohere embedding model: sizes only approximate the model's token counts
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.min_heading_fill = min_heading_fill
+        self.tokenizer = self.get_tokenizer(encoding_name)
+        self.metrics = metrics or PipelineMetrics()
+        self.journal = journal
+        self.manifest = manifest
+
+        # Optional Deduplicator, near-duplicate chunks are dropped or linked to their first occurrence
+        self.deduplicator = deduplicator
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def get_tokenizer(encoding_name):
+        # Loaded once per process. None when tiktoken or its vocabulary is not available,
+        # sizes are then estimated from the number of characters
+        try:
+            import tiktoken
+            return tiktoken.get_encoding(encoding_name)
+        except Exception as e:
+            logging.getLogger(__name__).warning(
+                f"Chunker: Tokenizer {encoding_name} is not available ({e}), chunk sizes are estimated "
+                f"at 4 characters per token and differ from the ones of environments that have it")
+            return None
+
+    def count_tokens(self, text):
+        if self.tokenizer is None:
+            return max(1, len(text) // 4)
+        return len(self.tokenizer.encode(text, disallowed_special=()))
+
+    def split_paragraph(self, text, separators=SEPARATORS):
+        # Cut a paragraph into pieces of at most chunk_size tokens at the coarsest separator
+        # possible, merging the parts back greedily. Returns [(text, tokens)]
+        tokens = self.count_tokens(text)
+        if tokens <= self.chunk_size:
+            return [(text, tokens)]
+        if not separators:
+            # No separator left, cut at token (or estimated character) boundaries
+            if self.tokenizer is None:
+                step = self.chunk_size * 4
+                return [(text[start:start + step], self.count_tokens(text[start:start + step]))
+                        for start in range(0, len(text), step)]
+            encoded = self.tokenizer.encode(text, disallowed_special=())
+            return [(self.tokenizer.decode(encoded[start:start + self.chunk_size]), len(encoded[start:start + self.chunk_size]))
+                    for start in range(0, len(encoded), self.chunk_size)]
+
+        pattern, joiner = separators[0]
+        pieces = []
+        current = []
+        size = 0
+        for part in re.split(pattern, text):
+            if not part.strip():
+                continue
+            part_tokens = self.count_tokens(part)
+            if current and size + part_tokens > self.chunk_size:
+                merged = joiner.join(current)
+                pieces.append((merged, self.count_tokens(merged)))
+                current, size = [], 0
+            if part_tokens > self.chunk_size:
+                pieces.extend(self.split_paragraph(part, separators[1:]))
+                continue
+            current.append(part)
+            size += part_tokens
+        if current:
+            merged = joiner.join(current)
+            pieces.append((merged, self.count_tokens(merged)))
+        return pieces
+
+    def iter_chunks(self, paragraphs):
+        # paragraphs is the ordered list of (page_number, text, role) of a document.
+        # Yields (text, first_page_number, last_page_number)
+        units = []  # (text, tokens, page_number) of the chunk being built
+        size = 0
+        for page_number, text, role in paragraphs:
+            if role in SKIPPED_ROLES or not text.strip():
+                continue
+            if role in HEADING_ROLES and size >= self.chunk_size * self.min_heading_fill:
+                yield self.join_units(units)
+                units, size = [], 0
+
+            for piece, tokens in self.split_paragraph(text.strip()):
+                if units and size + tokens > self.chunk_size:
+                    yield self.join_units(units)
+                    units = self.overlap_units(units, tokens)
+                    size = sum(unit[1] for unit in units)
+                units.append((piece, tokens, page_number))
+                size += tokens
+
+        if units:
+            yield self.join_units(units)
+
+    def overlap_units(self, units, next_tokens):
+        # Trailing units of the previous chunk that fit in chunk_overlap and next to the next unit
+        overlap = []
+        size = 0
+        for unit in reversed(units):
+            size += unit[1]
+            if size > self.chunk_overlap or size + next_tokens > self.chunk_size:
+                break
+            overlap.insert(0, unit)
+        return overlap
+
+    @staticmethod
+    def join_units(units):
+        return "\n".join(unit[0] for unit in units), units[0][2], units[-1][2]
+
+    async def chunk_text(self, text_queue, chunk_queue, worker_id, logger):
+        while True:
+            data = await text_queue.get()
+            if data is None:  # Sentinel to end the loop
+                text_queue.task_done()
+                break
+
+            blob_name, blob_uri, paragraphs, parent_id = data
+            try:
+                # Per-document messages are debug level and lazily formatted, they are on the hot path
+                logger.debug("Chunker %s: Chunking document %s", worker_id, blob_name)
+
+                # Tokenizing a whole document is CPU-bound, it runs off the event loop so that
+                # the other stages keep going
+                start_time = time.time()
+                chunks = await asyncio.to_thread(lambda: list(self.iter_chunks(paragraphs)))
+                chunk_time = time.time() - start_time
+                self.metrics.observe("chunk", chunk_time, items=len(chunks), bytes=sum(len(text) for _, text, _ in paragraphs))
+                logger.debug("Chunker %s: Finished chunking %s into %d chunks in %.2f seconds", worker_id, blob_name, len(chunks), chunk_time)
+
+                # Put each chunk into the chunk queue with an id derived from its position in the document,
+                # and the id of its canonical chunk when it is a near-duplicate
+                chunk_count = 0
+                for position, (chunk, page_number, last_page_number) in enumerate(chunks):
+                    chunk_id = IndexManifest.make_chunk_id(parent_id, "text", page_number, position)
+                    canonical_id = None
+                    if self.deduplicator is not None:
+                        canonical_id = self.deduplicator.find_canonical(
+                            "text", self.deduplicator.text_fingerprint(chunk), chunk_id, blob_name)
+                        if canonical_id is not None and self.deduplicator.mode == "skip":
+                            continue
+                    await chunk_queue.put((blob_name, blob_uri, chunk, parent_id, page_number, chunk_id, last_page_number, canonical_id))
+                    chunk_count += 1
+                if self.journal is not None:
+                    self.journal.record_chunked(blob_name, chunk_count)
+                if self.manifest is not None:
+                    self.manifest.record_chunked(blob_name, chunk_count)
+            except Exception as e:
+                self.metrics.count("chunk", "errors")
+                logger.error(f"Chunker {worker_id}: Error chunking document {blob_name}: {e}")
+            finally:
+                text_queue.task_done()
@@ -0,0 +1,97 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+
+# Status codes signalling that the service is over its quota
+THROTTLING_STATUS_CODES = {429, 503}
+
+class ConcurrencyController:
+    def __init__(self, initial_limit=None, min_limit=1, max_limit=None, adaptive=False,
+                 target_latency=None, decrease_factor=0.5, cooldown=1.0):
+        # Limits the number of concurrent calls to a service. With adaptive=True the limit follows
+        # AIMD: it grows by about one slot per limit-worth of successful calls and is multiplied
+        # by decrease_factor on throttling, or when latency exceeds target_latency.
+        # initial_limit=None means no limit at all.
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit if max_limit is not None else initial_limit
+        self.adaptive = adaptive and initial_limit is not None
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown  # Minimum seconds between two decreases
+
+        # Set once the client reports its responses through observe_response
+        self.observes_responses = False
+
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+        self.last_decrease = 0.0
+
+        # Counters
+        self.calls = 0
+        self.throttled = 0
+
+    def current_limit(self):
+        return None if self.limit is None else max(self.min_limit, int(self.limit))
+
+    @asynccontextmanager
+    async def slot(self):
+        # Wait for a free slot, then time the call and feed the outcome back to the limit
+        async with self.condition:
+            while self.limit is not None and self.in_flight >= self.current_limit():
+                await self.condition.wait()
+            self.in_flight += 1
+
+        start_time = time.time()
+        try:
+            yield
+        except Exception as e:
+            # Clients without a response hook only report the throttling that survived their retries
+            if not self.observes_responses and getattr(e, "status_code", None) in THROTTLING_STATUS_CODES:
+                self.record_throttle()
+            raise
+        else:
+            self.record_latency(time.time() - start_time)
+        finally:
+            async with self.condition:
+                self.in_flight -= 1
+                self.condition.notify_all()
+
+    def record_latency(self, latency):
+        self.calls += 1
+        if not self.adaptive:
+            return
+        if self.target_latency is not None and latency > self.target_latency:
+            self.decrease()
+        else:
+            # Additive increase: about one more slot once a full window of calls has succeeded
+            self.limit = min(self.max_limit, self.limit + 1 / max(1, self.current_limit()))
+
+    def observe_response(self, response):
+        # raw_response_hook of the Azure SDK clients. Their RetryPolicy retries 429 and 503
+        # responses with its own backoff before any exception reaches slot(), the hook runs
+        # after it in the pipeline and sees every attempt, so those are counted here
+        self.observes_responses = True
+        if response.http_response.status_code in THROTTLING_STATUS_CODES:
+            self.record_throttle()
+
+    def record_throttle(self):
+        # Also called directly for per-item throttling inside otherwise successful responses
+        self.throttled += 1
+        if self.adaptive:
+            self.decrease()
+
+    def decrease(self):
+        # Multiplicative decrease, at most once per cooldown so that a burst of
+        # responses from the same overloaded window only counts once
+        now = time.time()
+        if now - self.last_decrease >= self.cooldown:
+            self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+            self.last_decrease = now
+
+    def stats(self):
+        return {
+            "limit": self.current_limit(),
+            "calls": self.calls,
+            "throttled": self.throttled,
+        }
@@ -0,0 +1,95 @@
+import base64
+import hashlib
+import re
+from io import BytesIO
+import numpy as np
+from PIL import Image
+from .FingerprintIndex import FingerprintIndex
+
+# What happens to a near-duplicate: dropped, or indexed without a vector and linked to its canonical entry
+DEDUPLICATION_MODES = ("skip", "link")
+
+class Deduplicator:
+    def __init__(self, mode="skip", text_similarity=0.9, image_similarity=0.9, image_hash="dhash", shingle_size=3,
+                 per_blob=False):
+        # Near-duplicate detection with 64-bit fingerprints: SimHash over word shingles of the
+        # normalized text for chunks, a perceptual hash (dHash or pHash) for figures. Two items are
+        # duplicates when the share of equal fingerprint bits reaches the similarity threshold.
+        # The first occurrence seen during the run is the canonical entry. With per_blob=True
+        # duplicates are only searched within the same blob: the canonical entry is then always
+        # the first occurrence in the document, and it is re-indexed or deleted with its copies.
+        if mode not in DEDUPLICATION_MODES:
+            raise ValueError(f"Unknown deduplication mode {mode}, expected one of {DEDUPLICATION_MODES}")
+        if image_hash not in ("dhash", "phash"):
+            raise ValueError(f"Unknown image hash {image_hash}, expected dhash or phash")
+        self.mode = mode
+        self.image_hash = image_hash
+        self.shingle_size = shingle_size
+        self.per_blob = per_blob
+        self.max_distances = {
+            "text": int((1 - text_similarity) * 64),
+            "image": int((1 - image_similarity) * 64),
+        }
+
+        # FingerprintIndex of each (kind, blob name), the blob name is None across blobs
+        self.indexes = {}
+
+        # Counters
+        self.checked = {"text": 0, "image": 0}
+        self.duplicates = {"text": 0, "image": 0}
+
+    def text_fingerprint(self, text):
+        # SimHash: every shingle votes for the bits of its hash, the fingerprint keeps the majority
+        words = re.sub(r"[^\w\s]", " ", text.lower()).split()
+        if not words:
+            return 0
+        size = min(self.shingle_size, len(words))
+        shingles = {" ".join(words[start:start + size]) for start in range(len(words) - size + 1)}
+        hashes = np.array(
+            [int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), "big") for shingle in shingles],
+            dtype=np.uint64
+        )
+        bits = np.unpackbits(hashes.byteswap().view(np.uint8).reshape(-1, 8), axis=1)
+        votes = bits.sum(axis=0) * 2 > len(hashes)
+        return int("".join("1" if vote else "0" for vote in votes), 2)
+
+    def image_fingerprint(self, image_data):
+        # image_data is the base64 data URL produced by the reader
+        image = Image.open(BytesIO(base64.b64decode(image_data.split(",", 1)[1]))).convert("L")
+        if self.image_hash == "dhash":
+            # Sign of the horizontal gradients of a 9x8 thumbnail
+            pixels = np.asarray(image.resize((9, 8), Image.LANCZOS), dtype=np.float64)
+            bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+        else:
+            # Low frequencies of the DCT of a 32x32 thumbnail compared to their median
+            pixels = np.asarray(image.resize((32, 32), Image.LANCZOS), dtype=np.float64)
+            n = np.arange(32)
+            dct_matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / 64)
+            low_frequencies = (dct_matrix @ pixels @ dct_matrix.T)[:8, :8].flatten()
+            bits = low_frequencies > np.median(low_frequencies[1:])
+        return int("".join("1" if bit else "0" for bit in bits), 2)
+
+    def find_canonical(self, kind, fingerprint, item_id, blob_name=None):
+        # Returns the id of the canonical entry the item duplicates, None when the item is new
+        # (it then becomes the canonical entry of its own near-duplicates)
+        self.checked[kind] += 1
+        scope = (kind, blob_name if self.per_blob else None)
+        if scope not in self.indexes:
+            self.indexes[scope] = FingerprintIndex(self.max_distances[kind])
+        canonical_id = self.indexes[scope].find(fingerprint)
+        if canonical_id is None:
+            self.indexes[scope].add(fingerprint, item_id)
+            return None
+        self.duplicates[kind] += 1
+        return canonical_id
+
+    def stats(self):
+        return {
+            kind: {
+                "checked": self.checked[kind],
+                "duplicates": self.duplicates[kind],
+                "duplicate_rate": self.duplicates[kind] / self.checked[kind] if self.checked[kind] else 0.0,
+            }
+            for kind in self.checked
+        }
+
@@ -0,0 +1,33 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+class DownloadBudget:
+    def __init__(self, max_bytes=None):
+        # Bounds the bytes of the documents held by all reader workers at once.
+        # max_bytes=None means no limit at all.
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.condition = asyncio.Condition()
+
+        # Peak of the reserved bytes, for the end-of-run metrics
+        self.max_in_flight = 0
+
+    @asynccontextmanager
+    async def reserve(self, size):
+        # A document larger than the whole budget waits for the budget to be empty and runs alone
+        if self.max_bytes is not None:
+            size = min(size, self.max_bytes)
+        async with self.condition:
+            while self.max_bytes is not None and self.in_flight and self.in_flight + size > self.max_bytes:
+                await self.condition.wait()
+            self.in_flight += size
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.in_flight -= size
+                self.condition.notify_all()
+
+    def stats(self):
+        return {"max_bytes": self.max_bytes, "max_in_flight_bytes": self.max_in_flight}
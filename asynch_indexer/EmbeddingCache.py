@@ -0,0 +1,117 @@
+import hashlib
+import sqlite3
+import time
+import numpy as np
+
+# Number of cache hits whose access time is kept in memory before being written
+ACCESS_FLUSH_SIZE = 1000
+
+class EmbeddingCache:
+    def __init__(self, cache_path, max_entries=1_000_000):
+        # Persistent store of vectors keyed by a hash of the model name and the embedded content
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # The calls are made from the event loop: with WAL, NORMAL skips the fsync of every commit
+        # and a crash can only lose the last entries, which are recomputed
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_last_access ON embeddings (last_access)"
+        )
+        self.connection.commit()
+
+        # Upper bound on the number of stored entries, recounted only when eviction may be needed
+        self.entry_count = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+        # Access times of the hits not written yet, the lookups themselves do not write
+        self.accessed = {}
+
+        # Hit/miss counters for the current process
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model, content):
+        # Content is either chunk text or raw image bytes
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        digest = hashlib.sha256(model.encode('utf-8'))
+        digest.update(b"\0")
+        digest.update(content)
+        return digest.hexdigest()
+
+    def get_many(self, keys):
+        # Return a {key: vector} dict for the keys found in the cache
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        # Stay below SQLite's limit on the number of bound parameters
+        for start in range(0, len(unique_keys), 500):
+            batch = unique_keys[start:start + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.connection.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+            ).fetchall()
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float32)
+
+        # Refresh the access time of the hits so eviction is least-recently-used, in batches
+        now = time.time()
+        for key in found:
+            self.accessed[key] = now
+        if len(self.accessed) >= ACCESS_FLUSH_SIZE:
+            self.write_access_times()
+            self.connection.commit()
+
+        self.hits += sum(1 for key in keys if key in found)
+        self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, items):
+        # Store (key, vector) pairs as compact float32 blobs
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vector, last_access) VALUES (?, ?, ?)",
+            [(key, np.asarray(vector, dtype=np.float32).tobytes(), now) for key, vector in items]
+        )
+        self.entry_count += len(items)
+        self.write_access_times()
+        if self.entry_count > self.max_entries:
+            self.evict()
+        self.connection.commit()
+
+    def write_access_times(self):
+        if self.accessed:
+            self.connection.executemany(
+                "UPDATE embeddings SET last_access = ? WHERE key = ?",
+                [(now, key) for key, now in self.accessed.items()]
+            )
+            self.accessed = {}
+
+    def evict(self):
+        # Drop the least recently used entries once the cache grows beyond max_entries
+        count = self.connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        if count > self.max_entries:
+            self.connection.execute(
+                "DELETE FROM embeddings WHERE key IN ("
+                "SELECT key FROM embeddings ORDER BY last_access LIMIT ?)",
+                (count - self.max_entries,)
+            )
+            count = self.max_entries
+        self.entry_count = count
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        self.write_access_times()
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,135 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from io import BytesIO
+from pdf2image import convert_from_path
+from PIL import Image
+from .ImageEmbedder import ImageEmbedder
+
+# Image formats sent to the image embedding model as they are, the others are re-encoded
+EMBEDDABLE_FORMATS = {"PNG", "JPEG", "GIF", "WEBP"}
+
+# Embedded images thinner than this (bullets, spacers, rules) are not figures
+MIN_IMAGE_SIDE = 32
+
+# Images with a longer side are downscaled before encoding
+MAX_IMAGE_SIDE = 2048
+
+class FigureExtractor:
+    def __init__(self, max_workers=None, poppler_path=None):
+        # Rasterizing, cropping and encoding are CPU-bound, they run in worker processes
+        # so that they scale with the number of cores instead of sharing the GIL
+        self.max_workers = max_workers or os.cpu_count()
+        self.poppler_path = poppler_path
+        self.executor = None
+
+    @staticmethod
+    def extract_page_figures(pdf_path, page_number, page_width, page_height, polygons, dpi, poppler_path):
+        # Runs in a worker process: rasterize a single page and return its figures as data URLs
+        page_image = convert_from_path(
+            pdf_path,
+            dpi=dpi,
+            first_page=page_number,
+            last_page=page_number,
+            poppler_path=poppler_path
+        )[0]
+
+        # Map the polygon coordinates (in the page unit, 'pixel' or 'inch') to rendered pixels
+        x_scale = page_image.width / page_width
+        y_scale = page_image.height / page_height
+
+        data_urls = []
+        for polygon in polygons:
+            x_coords = [x * x_scale for x in polygon[0::2]]
+            y_coords = [y * y_scale for y in polygon[1::2]]
+
+            # Ensure coordinates are within image bounds
+            left = int(max(min(x_coords), 0))
+            upper = int(max(min(y_coords), 0))
+            right = int(min(max(x_coords), page_image.width))
+            lower = int(min(max(y_coords), page_image.height))
+
+            # Crop the figure from the page image and encode it once, straight to the payload
+            figure_image = page_image.crop((left, upper, right, lower))
+            image_buffer = BytesIO()
+            figure_image.save(image_buffer, format='PNG')
+            data_urls.append(ImageEmbedder.convert_to_base64_data_url(image_buffer.getvalue()))
+
+        page_image.close()
+        return data_urls
+
+    @staticmethod
+    def encode_image(image_data, min_side=MIN_IMAGE_SIDE):
+        # Native image bytes in, data URL out. Embeddable images are encoded as they are, without
+        # decoding them; other formats (BMP, TIFF...) and oversized images are re-encoded.
+        # None for images that cannot be decoded (EMF, WMF...) or are thinner than min_side
+        try:
+            image = Image.open(BytesIO(image_data))
+            image_format = image.format
+            if min(image.size) < min_side:
+                return None
+            if image_format in EMBEDDABLE_FORMATS and max(image.size) <= MAX_IMAGE_SIDE:
+                return ImageEmbedder.convert_to_base64_data_url(image_data)
+
+            image.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+            image_buffer = BytesIO()
+            if image_format == "JPEG":
+                image.convert("RGB").save(image_buffer, format="JPEG", quality=90)
+            else:
+                if image.mode not in ("1", "L", "LA", "P", "RGB", "RGBA"):
+                    image = image.convert("RGBA")
+                image.save(image_buffer, format="PNG")
+            return ImageEmbedder.convert_to_base64_data_url(image_buffer.getvalue())
+        except Exception:
+            return None
+
+    @staticmethod
+    def encode_image_file(image_path):
+        # A standalone image is a figure whatever its size
+        with open(image_path, "rb") as image_file:
+            return FigureExtractor.encode_image(image_file.read(), min_side=1)
+
+    def get_executor(self):
+        # Created on first use, once the event loop already runs threads and holds SQLite
+        # connections: worker processes are started from a clean forkserver (spawn where it
+        # is not available) instead of forking that state
+        if self.executor is None:
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=multiprocessing.get_context(start_method)
+            )
+        return self.executor
+
+    async def run(self, function, *args):
+        # Run a CPU-bound function in the process pool. A worker that dies (e.g. poppler killed
+        # for lack of memory) breaks the whole pool: it is replaced and the call retried once
+        for attempt in range(2):
+            executor = self.get_executor()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+            except BrokenProcessPool:
+                if attempt:
+                    raise
+                if self.executor is executor:
+                    executor.shutdown(wait=False)
+                    self.executor = None
+
+    async def extract_figures(self, pdf_path, pages):
+        # pages is a list of (page_number, page_width, page_height, polygons, dpi).
+        # Returns the data URLs of every page, in the same order.
+        # Worker processes read the PDF the reader downloaded to disk instead of
+        # receiving a pickled copy of the whole document for every page
+        return await asyncio.gather(*[
+            self.run(
+                self.extract_page_figures, pdf_path,
+                page_number, page_width, page_height, polygons, dpi, self.poppler_path
+            )
+            for page_number, page_width, page_height, polygons, dpi in pages
+        ])
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
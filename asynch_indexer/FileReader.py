@@ -1,148 +1,419 @@
 import time  
-import uuid  
 import os
+import re
 import asyncio  
-from io import BytesIO  
+import tempfile
+import functools
+from pypdf import PdfReader, PdfWriter
 from azure.core.credentials import AzureKeyCredential  
-from azure.ai.documentintelligence import DocumentIntelligenceClient  
-from pdf2image import convert_from_bytes  
+from azure.ai.documentintelligence.aio import DocumentIntelligenceClient  
+from azure.ai.documentintelligence.models import AnalyzeResult
+from .AnalysisCache import AnalysisCache
+from .IndexManifest import IndexManifest  
+from .FigureExtractor import FigureExtractor  
+from .LocalExtractor import LocalExtractor
+from .ReaderRegistry import ReaderRegistry, FORMATS
+from .DownloadBudget import DownloadBudget  
+from .ConcurrencyController import ConcurrencyController  
+from .PipelineMetrics import PipelineMetrics  
+  
+# Top-level lists of an analyze result that are concatenated when merging page ranges  
+MERGED_ELEMENTS = ("pages", "paragraphs", "tables", "figures", "sections", "styles", "languages")  
+
+# Text extraction of the DOCX, PPTX and HTML documents, their figures are always read natively
+OFFICE_EXTRACTIONS = ("document_intelligence", "local")
   
 class FileReader:  
-    def __init__(self, document_intelligence_endpoint, document_intelligence_key):  
-        # Initialize the Document Intelligence client  
+    def __init__(self, document_intelligence_endpoint, document_intelligence_key,  
+                 min_dpi=72, max_dpi=300, target_figure_pixels=1024, cpu_workers=None,  
+                 limiter=None, metrics=None, journal=None, model_id="prebuilt-layout",  
+                 analysis_cache=None, pages_per_request=None, download_budget=None,  
+                 download_concurrency=4, parallel_download_threshold=64 * 1024 * 1024, deduplicator=None,
+                 registry=None, office_extraction="document_intelligence", manifest=None):  
+        if office_extraction not in OFFICE_EXTRACTIONS:
+            raise ValueError(f"Unknown office extraction {office_extraction}, expected one of {OFFICE_EXTRACTIONS}")
+        # Initialize the async Document Intelligence client  
         self.document_client = DocumentIntelligenceClient(  
             endpoint=document_intelligence_endpoint,  
-            credential=AzureKeyCredential(document_intelligence_key)  
+            credential=AzureKeyCredential(document_intelligence_key),  
+            # Throttled responses retried inside the client still shrink the concurrency limit  
+            raw_response_hook=lambda response: self.limiter.observe_response(response)  
+        )  
+  
+        self.model_id = model_id  
+  
+        # Optional AnalysisCache, documents analyzed before are served from it  
+        self.analysis_cache = analysis_cache  
+  
+        # Documents with more pages are analyzed as concurrent page ranges of this size,  
+        # disabled by default  
+        self.pages_per_request = pages_per_request  
+  
+        # Bytes of the documents held by all reader workers at once, unlimited by default.  
+        # Blobs of at least parallel_download_threshold bytes are downloaded as  
+        # download_concurrency parallel ranges  
+        self.download_budget = download_budget or DownloadBudget()  
+        self.download_concurrency = download_concurrency  
+        self.parallel_download_threshold = parallel_download_threshold  
+  
+        # Limits the number of concurrent Document Intelligence calls, unlimited by default  
+        self.limiter = limiter or ConcurrencyController()  
+        self.metrics = metrics or PipelineMetrics()  
+  
+        # Optional IndexingJournal, used to resume interrupted runs  
+        self.journal = journal  
+
+        # Optional IndexManifest, told how many items each blob produced in incremental mode
+        self.manifest = manifest
+  
+        # Optional Deduplicator, near-duplicate figures are dropped or linked to their first occurrence  
+        self.deduplicator = deduplicator  
+  
+        # Figure pages are rendered at a DPI chosen so that the largest figure on the page  
+        # spans about target_figure_pixels, clamped to [min_dpi, max_dpi]  
+        self.min_dpi = min_dpi  
+        self.max_dpi = max_dpi  
+        self.target_figure_pixels = target_figure_pixels  
+  
+        # Process pool shared by all reader workers for rendering, cropping and encoding figures  
+        self.figure_extractor = FigureExtractor(  
+            max_workers=cpu_workers,  
+            poppler_path=os.environ.get("POPPLER_PATH")  
         )  
+
+        # Reader of each format, blobs of the formats without a reader are not listed for indexing.
+        # Office and HTML text comes from Document Intelligence or from the local extractor
+        self.office_extraction = office_extraction
+        if registry is None:
+            registry = ReaderRegistry()
+            self.register_default_readers(registry)
+        self.registry = registry
+
+    def register_default_readers(self, registry):
+        registry.register(self.extract_pdf, *FORMATS["pdf"])
+        registry.register(self.extract_image, *FORMATS["image"])
+        for kind in ("docx", "pptx", "html"):
+            registry.register(functools.partial(self.extract_document, kind), *FORMATS[kind])
   
-    async def read_pdf(self, container_client, file_queue, text_queue, image_queue, worker_id, logger):  
+    async def read_files(self, container_client, file_queue, text_queue, image_queue, worker_id, logger):  
         while True:  
             blob = await file_queue.get()  
             if blob is None:  
                 file_queue.task_done()  
                 break  
   
-            parent_id = str(uuid.uuid4())  
+            try:  
+                logger.info(f"Reader {worker_id}: Reading document {blob.name}")  
+                start_time = time.time()  
   
-            logger.info(f"Reader {worker_id}: Reading document {blob.name}")  
-            start_time = time.time()  
-  
-            blob_client = container_client.get_blob_client(blob)  
+                blob_client = container_client.get_blob_client(blob)  
             
-            # Get the blob URI without SAS token  
-            blob_uri = blob_client.url
-  
-            # Download the blob data asynchronously  
-            stream = await blob_client.download_blob()  
-            data = await stream.readall()  
-  
-            # Run the synchronous analyze_document in a separate thread  
-            result = await asyncio.to_thread(self.analyze_document, data)  
-            logger.info(f"Reader {worker_id}: Completed analyze_document for {blob.name}")  
-  
-            # Extract text and images  
-            text_pages = []  
-            images = []  
-  
-            for page in result.pages:  
-                page_text = "\n".join([line.content for line in page.lines])  
-                text_pages.append((blob.name, blob_uri, page_text, parent_id, page.page_number))  
-  
-            # Convert the PDF pages to images in a separate thread to prevent blocking  
-            dpi = 300  # Adjust DPI as needed  
-            #poppler_path= r"C:\Users\kchouchen\Desktop\AI-search-multimodality-ip\.venv\Lib\site-packages\poppler-24.08.0\Library\bin"
-            poppler_path= os.environ["POPPLER_PATH"] 
-            pages_images = await asyncio.to_thread(  
-                convert_from_bytes,  
-                data,  
-                dpi=dpi,  
-                poppler_path=poppler_path  
-            )   
-  
-            # Map page numbers to page objects  
-            pages_by_number = {page.page_number: page for page in result.pages}  
-  
-            # Extract images from the page  
-            if result.figures:  
-                logger.info(f"Reader {worker_id}: Found {len(result.figures)} figures in {blob.name}")  
-                for figure in result.figures:  
-                    for region in figure.bounding_regions:  
-                        page_number = region.page_number  
-                        polygon = region.polygon  # List of x, y coordinates  
-  
-                        # Get the corresponding page image  
-                        page_image = pages_images[page_number - 1]  
-  
-                        # Get the page object to determine units  
-                        page = pages_by_number[page_number]  
-                        unit = page.unit  # 'pixel' or 'inch'  
-  
-                        # Map the polygon coordinates to pixel values  
-                        x_coords = polygon[0::2]  
-                        y_coords = polygon[1::2]  
-  
-                        if unit == 'pixel':  
-                            # Coordinates are already in pixels  
-                            pass  
-                        elif unit == 'inch':  
-                            # Convert inches to pixels (dpi is dots per inch)  
-                            x_coords = [x * dpi for x in x_coords]  
-                            y_coords = [y * dpi for y in y_coords]  
-                        else:  
-                            logger.warning(f"Unknown unit '{unit}' in page {page_number}")  
-                            continue  
-  
-                        x_min = min(x_coords)  
-                        x_max = max(x_coords)  
-                        y_min = min(y_coords)  
-                        y_max = max(y_coords)  
-  
-                        # Ensure coordinates are within image bounds  
-                        left = int(max(x_min, 0))  
-                        upper = int(max(y_min, 0))  
-                        right = int(min(x_max, page_image.width))  
-                        lower = int(min(y_max, page_image.height))  
-  
-                        # Crop the figure from the page image  
-                        figure_image = page_image.crop((left, upper, right, lower))  
-  
-                        # Convert the image to bytes  
-                        image_buffer = BytesIO()  
-                        figure_image.save(image_buffer, format='PNG')  
-                        image_data = image_buffer.getvalue()  
-  
-                        # Append the image data to the images list  
-                        images.append((blob.name, blob_uri, image_data, parent_id, page_number))  
-            else:  
-                logger.info(f"Reader {worker_id}: No figures found in {blob.name}")  
-  
-            read_time = time.time() - start_time  
-            logger.info(f"Reader {worker_id}: Finished reading {blob.name} in {read_time:.2f} seconds")  
-  
-            # Put the text pages into the text queue  
-            for page_data in text_pages:  
-                await text_queue.put(page_data)  
-  
-            # Put the images into the image queue  
-            for image_data in images:  
-                await image_queue.put(image_data)  
-  
-            file_queue.task_done()  
-            logger.info(f"Reader {worker_id}: Done processing {blob.name}")  
-  
-    def analyze_document(self, data):  
-        poller = self.document_client.begin_analyze_document(  
-            model_id="prebuilt-layout",  
-            body=data 
-        )  
-        result = poller.result()  
-        return result  
-
-
-
+                # Get the blob URI without SAS token  
+                blob_uri = blob_client.url
 
+                # Deterministic id so that re-indexing the blob replaces its documents  
+                parent_id = IndexManifest.make_parent_id(blob_uri)  
+  
+                reader = self.registry.get(blob)
+                if reader is None:
+                    raise ValueError("No reader is registered for its format")
 
+                # Resume from the analysis stored by an interrupted run, or analyze the blob  
+                stored = self.journal.load_analyzed(blob) if self.journal is not None else None  
+                if stored is not None:  
+                    paragraphs, figures = stored  
+                    images = [  
+                        (blob.name, blob_uri, image_data, parent_id, page_number, image_id)  
+                        for page_number, image_id, image_data in figures  
+                    ]  
+                    size = 0  
+                    logger.info(f"Reader {worker_id}: Resuming {blob.name} from its stored analysis")  
+                else:  
+                    paragraphs, images, size = await self.analyze_blob(reader, blob_client, blob, blob_uri, parent_id, worker_id, logger)  
+                    if self.journal is not None:  
+                        self.journal.record_analyzed(blob, paragraphs, images)  
+  
+                images = await self.deduplicate_images(images)  
+                if self.journal is not None:  
+                    self.journal.start_tracking(blob.name, 1 if paragraphs else 0, len(images))  
+                if self.manifest is not None:
+                    self.manifest.start_tracking(blob.name, 1 if paragraphs else 0, len(images))
+  
+                read_time = time.time() - start_time  
+                self.metrics.observe("read", read_time, bytes=size)  
+                logger.info(f"Reader {worker_id}: Finished reading {blob.name} in {read_time:.2f} seconds")  
+  
+                # Put the text of the whole document into the text queue, the chunker packs it across pages.  
+                # Standalone images have no text  
+                if paragraphs:
+                    await text_queue.put((blob.name, blob_uri, paragraphs, parent_id))  
+  
+                # Put the images into the image queue  
+                for image_data in images:  
+                    await image_queue.put(image_data)  
+  
+                logger.info(f"Reader {worker_id}: Done processing {blob.name}")  
+            except Exception as e:  
+                self.metrics.count("read", "errors")  
+                logger.error(f"Reader {worker_id}: Error processing document {blob.name}: {e}")  
+            finally:  
+                file_queue.task_done()  
+  
+    async def analyze_blob(self, reader, blob_client, blob, blob_uri, parent_id, worker_id, logger):  
+        # Download the blob and read it with the reader of its format, returns its paragraphs,  
+        # its figures and its size. The blob is streamed to a temporary file that feeds both the  
+        # analysis and the figure extraction, its size is reserved in the download budget until  
+        # the file is removed  
+        size = blob.size or 0  
+        async with self.download_budget.reserve(size):  
+            path = await self.download_to_file(blob_client, blob, size)  
+            try:  
+                paragraphs, images = await reader(path, blob, blob_uri, parent_id, worker_id, logger)  
+            finally:  
+                os.remove(path)  
+        return paragraphs, images, size  
+  
+    async def download_to_file(self, blob_client, blob, size):  
+        # Large blobs are downloaded as parallel ranges, written in place by the SDK.  
+        # The file keeps the extension of the blob  
+        max_concurrency = self.download_concurrency if size >= self.parallel_download_threshold else 1  
+        blob_file = tempfile.NamedTemporaryFile(suffix=os.path.splitext(blob.name)[1].lower(), delete=False)  
+        try:  
+            with blob_file:  
+                stream = await blob_client.download_blob(max_concurrency=max_concurrency)  
+                await stream.readinto(blob_file)  
+        except Exception:  
+            os.remove(blob_file.name)  
+            raise  
+        return blob_file.name  
+  
+    async def extract_pdf(self, pdf_path, blob, blob_uri, parent_id, worker_id, logger):  
+        with self.metrics.track("analyze") as observation:  
+            observation["bytes"] = os.path.getsize(pdf_path)  
+            result = await self.analyze_document(pdf_path)  
+        logger.info(f"Reader {worker_id}: Completed analyze_document for {blob.name}")  
+  
+        paragraphs = self.paragraphs_from_result(result)  
+        images = []  
+  
+        # Group the figure regions by page so that only those pages are rendered  
+        pages_by_number = {page.page_number: page for page in result.pages}  
+        regions_by_page = {}  
+        for figure in result.figures or []:  
+            for region in figure.bounding_regions:  
+                regions_by_page.setdefault(region.page_number, []).append(region.polygon)  
+  
+        # Render each figure page in the process pool, crop its figures and encode them as data URLs  
+        if regions_by_page:  
+            logger.info(f"Reader {worker_id}: Found {len(result.figures)} figures on {len(regions_by_page)} pages in {blob.name}")  
+            figure_pages = []  
+            for page_number in sorted(regions_by_page):  
+                page = pages_by_number[page_number]  
+                polygons = regions_by_page[page_number]  
+                figure_pages.append((page_number, page.width, page.height, polygons, self.choose_dpi(page, polygons)))  
+            with self.metrics.track("figures") as observation:  
+                observation["items"] = len(figure_pages)  
+                pages_data_urls = await self.figure_extractor.extract_figures(pdf_path, figure_pages)  
+  
+            for (page_number, *_), data_urls in zip(figure_pages, pages_data_urls):  
+                for image_data in data_urls:  
+                    # Append the image payload to the images list, positioned by its order in the document  
+                    image_id = IndexManifest.make_chunk_id(parent_id, "image", page_number, len(images))  
+                    images.append((blob.name, blob_uri, image_data, parent_id, page_number, image_id))  
+        else:  
+            logger.info(f"Reader {worker_id}: No figures found in {blob.name}")
+  
+        return paragraphs, images  
 
+    async def extract_image(self, image_path, blob, blob_uri, parent_id, worker_id, logger):
+        # A standalone image goes straight to the image embedder, without analysis or rendering
+        data_url = await self.figure_extractor.run(FigureExtractor.encode_image_file, image_path)
+        if data_url is None:
+            raise ValueError("The image cannot be decoded")
+        image_id = IndexManifest.make_chunk_id(parent_id, "image", 1, 0)
+        return [], [(blob.name, blob_uri, data_url, parent_id, 1, image_id)]
 
+    async def extract_document(self, kind, path, blob, blob_uri, parent_id, worker_id, logger):
+        # DOCX, PPTX and HTML documents: the embedded images are read from the file as they are,
+        # the text comes from Document Intelligence or from the same local pass
+        paragraphs, figures = await self.figure_extractor.run(LocalExtractor.extract, path, kind)
+        if self.office_extraction == "document_intelligence":
+            with self.metrics.track("analyze") as observation:
+                observation["bytes"] = os.path.getsize(path)
+                result = await self.analyze_document(path)
+            logger.info(f"Reader {worker_id}: Completed analyze_document for {blob.name}")
+            paragraphs = self.paragraphs_from_result(result)
 
+        logger.info(f"Reader {worker_id}: Found {len(figures)} embedded figures in {blob.name}")
+        images = [
+            (blob.name, blob_uri, data_url, parent_id, page_number,
+             IndexManifest.make_chunk_id(parent_id, "image", page_number, position))
+            for position, (page_number, data_url) in enumerate(figures)
+        ]
+        return paragraphs, images
 
+    @staticmethod
+    def paragraphs_from_result(result):
+        # The paragraphs, in reading order with their page number and layout role  
+        # (title, sectionHeading, pageHeader...)  
+        if result.paragraphs:  
+            return [  
+                (paragraph.bounding_regions[0].page_number if paragraph.bounding_regions else None,  
+                 paragraph.content, paragraph.role)  
+                for paragraph in result.paragraphs  
+            ]  
+        # Models without paragraphs, one paragraph per page  
+        return [  
+            (page.page_number, "\n".join([line.content for line in page.lines or []]), None)  
+            for page in result.pages or []  
+        ]  
+  
+    async def deduplicate_images(self, images):  
+        # Append the id of the canonical image to near-duplicates (None to the others),  
+        # near-duplicates are dropped in skip mode  
+        if self.deduplicator is None:  
+            return [image + (None,) for image in images]  
+        fingerprints = await asyncio.to_thread(  
+            lambda: [self.deduplicator.image_fingerprint(image[2]) for image in images])  
+        kept = []  
+        for image, fingerprint in zip(images, fingerprints):  
+            canonical_id = self.deduplicator.find_canonical("image", fingerprint, image[5], image[0])  
+            if canonical_id is not None and self.deduplicator.mode == "skip":  
+                continue  
+            kept.append(image + (canonical_id,))  
+        return kept  
+  
+    def choose_dpi(self, page, polygons):  
+        # Render just sharp enough for the largest figure of the page to reach target_figure_pixels  
+        if page.unit != 'inch':  
+            return self.max_dpi  
+        largest = max(  
+            max(max(polygon[0::2]) - min(polygon[0::2]), max(polygon[1::2]) - min(polygon[1::2]))  
+            for polygon in polygons  
+        )  
+        if largest <= 0:  
+            return self.max_dpi  
+        return int(min(max(self.target_figure_pixels / largest, self.min_dpi), self.max_dpi))  
+  
+    async def analyze_document(self, pdf_path):  
+        # Serve documents analyzed before with the same model from the cache  
+        cache_key = None  
+        if self.analysis_cache is not None:  
+            cache_key = await asyncio.to_thread(AnalysisCache.make_key, self.model_id, pdf_path)  
+            cached = self.analysis_cache.get(cache_key)  
+            if cached is not None:  
+                self.metrics.count("analyze", "cache_hits")  
+                return AnalyzeResult(cached)  
+  
+        page_ranges = await self.split_page_ranges(pdf_path)  
+        try:  
+            results = await asyncio.gather(*[self.analyze_file(path) for _, path in page_ranges])  
+        finally:  
+            for _, path in page_ranges:  
+                if path != pdf_path:  
+                    os.remove(path)  
+        result = results[0] if len(results) == 1 else self.merge_results(results, [page_range for page_range, _ in page_ranges])  
+  
+        if self.analysis_cache is not None:  
+            self.analysis_cache.put(cache_key, result.as_dict())  
+        return result  
+  
+    async def analyze_file(self, path):  
+        # Each request streams its document from its own handle on the file  
+        with open(path, "rb") as document_file:  
+            async with self.limiter.slot():  
+                poller = await self.document_client.begin_analyze_document(  
+                    model_id=self.model_id,  
+                    body=document_file  
+                )  
+                return await poller.result()  
+  
+    async def split_page_ranges(self, pdf_path):  
+        # [(page_range, path)] of the requests analyzing the document, page_range is a "first-last"  
+        # string of 1-based page numbers and None for the whole document. Only PDFs are split,  
+        # other formats are analyzed in a single request  
+        if self.pages_per_request is None or not pdf_path.endswith(".pdf"):  
+            return [(None, pdf_path)]  
+        return await self.figure_extractor.run(FileReader.write_page_ranges, pdf_path, self.pages_per_request)  
+  
+    @staticmethod  
+    def write_page_ranges(pdf_path, pages_per_request):  
+        # Runs in a worker process. Each range is written to a PDF of its own pages, so that the  
+        # requests together upload about the size of the document instead of the whole document  
+        # each. Resources shared by pages of different ranges (fonts, repeated images) are copied  
+        # into every range that uses them. Documents that are small enough or cannot be read are  
+        # analyzed in a single request  
+        try:  
+            reader = PdfReader(pdf_path)  
+            page_count = len(reader.pages)  
+        except Exception:  
+            return [(None, pdf_path)]  
+        if page_count <= pages_per_request:  
+            return [(None, pdf_path)]  
+  
+        page_ranges = []  
+        try:  
+            for first in range(0, page_count, pages_per_request):  
+                last = min(first + pages_per_request, page_count)  
+                writer = PdfWriter()  
+                for page in reader.pages[first:last]:  
+                    writer.add_page(page)  
+                range_file = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)  
+                with range_file:  
+                    writer.write(range_file)  
+                page_ranges.append((f"{first + 1}-{last}", range_file.name))  
+        except Exception:  
+            for _, path in page_ranges:  
+                os.remove(path)  
+            raise  
+        return page_ranges  
+  
+    @staticmethod  
+    def merge_results(results, page_ranges):  
+        # Concatenate the results of the page ranges of a document into a single result: the  
+        # content offsets and the element references of each range are shifted past the previous  
+        # ones, and its page numbers, counted from 1 in the PDF of each range, are made absolute  
+        merged = None  
+        for result, page_range in zip(results, page_ranges):  
+            part = result.as_dict()  
+            page_numbers = [page["pageNumber"] for page in part.get("pages") or []]  
+            page_offset = int(page_range.split("-")[0]) - min(page_numbers) if page_numbers else 0  
+            if merged is None:  
+                FileReader.shift_references(part, 0, {}, page_offset)  
+                merged = part  
+                continue  
+  
+            counts = {name: len(merged.get(name) or []) for name in MERGED_ELEMENTS}  
+            FileReader.shift_references(part, len(merged.get("content") or ""), counts, page_offset)  
+            merged["content"] = (merged.get("content") or "") + (part.get("content") or "")  
+            for name in MERGED_ELEMENTS:  
+                if part.get(name):  
+                    merged[name] = (merged.get(name) or []) + part[name]  
+        return AnalyzeResult(merged)  
+  
+    @staticmethod  
+    def shift_references(value, offset, counts, page_offset):  
+        # Walk a serialized result in place: span offsets, "/paragraphs/3"-style element  
+        # references and page numbers  
+        if isinstance(value, list):  
+            for item in value:  
+                FileReader.shift_references(item, offset, counts, page_offset)  
+        elif isinstance(value, dict):  
+            for key, item in value.items():  
+                if key == "spans":  
+                    for span in item:  
+                        span["offset"] += offset  
+                elif key == "elements":  
+                    value[key] = [  
+                        re.sub(r"^/(\w+)/(\d+)",  
+                               lambda match: f"/{match[1]}/{int(match[2]) + counts.get(match[1], 0)}", element)  
+                        for element in item  
+                    ]  
+                elif key == "pageNumber":  
+                    value[key] = item + page_offset  
+                else:  
+                    FileReader.shift_references(item, offset, counts, page_offset)  
+  
+    async def close(self):  
+        await self.document_client.close()  
+        self.figure_extractor.close()  
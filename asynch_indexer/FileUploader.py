@@ -1,57 +1,212 @@
-from azure.search.documents import SearchIndexingBufferedSender  
-from azure.core.credentials import AzureKeyCredential  
-  
-class FileUploader:  
-    def __init__(self, service_endpoint, index_name, api_key):  
-        # Initialize the SearchIndexingBufferedSender  
-        self.sender = SearchIndexingBufferedSender(  
-            endpoint=service_endpoint,  
-            index_name=index_name,  
-            credential=AzureKeyCredential(api_key),  
-            auto_flush_interval=2,  # Automatically flush every 2 seconds  
-            on_error=self.on_error,  
-        )  
-  
-    def on_error(self, index_documents_batch, index_documents_result):  
-        # Handle errors during indexing  
-        for doc, result in zip(index_documents_batch, index_documents_result):  
-            if not result.succeeded:  
-                print(f"Failed to index document: {doc.get('chunk_id')} - Error: {result.error.message}")  
-  
-    async def upload_documents(self, vector_queue, worker_id, logger):  
-        while True:  
-            document = await vector_queue.get()  
-            if document is None:  # Sentinel to end the loop  
-                vector_queue.task_done()  
-                break  
-  
-            logger.info(f"Uploader {worker_id}: Uploading chunk {document['chunk_id']} of document {document['parent_id']}")  
-  
-            try:  
-                # Prepare the document for indexing  
-                index_document = {  
-                    "parent_id": document["parent_id"],  
-                    "chunk_id": document["chunk_id"],  
-                    "title": document.get("title", ""),  
-                    "chunk": document.get("chunk", ""),  
-                    "text_vector": document.get("text_vector"),  
-                    "image_vector": document.get("image_vector"),  
-                    "page_number": document.get("page_number"),  
-                    "content_type": document.get("content_type"),  
-                    "source_link": document.get("source_link"),  
-                }  
-  
-                # Remove fields with None values to prevent indexing errors  
-                index_document = {k: v for k, v in index_document.items() if v is not None}  
-  
-                # Upload the document  
-                self.sender.upload_documents([index_document])  
-                logger.info(f"Uploader {worker_id}: Successfully uploaded {document['chunk_id']}")  
-            except Exception as e:  
-                logger.error(f"Uploader {worker_id}: Error uploading document {document['chunk_id']}: {e}")  
-            finally:  
-                vector_queue.task_done()  
-  
-    async def close(self):  
-        # Flush any remaining documents and close the sender  
-        self.sender.close()
\ No newline at end of file
+import asyncio
+import random
+import time
+import numpy as np
+from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError
+from azure.search.documents.aio import SearchClient
+from .BatchCollector import BatchCollector
+from .ConcurrencyController import ConcurrencyController, THROTTLING_STATUS_CODES
+from .PipelineMetrics import PipelineMetrics
+
+# Per-document and per-request status codes worth retrying
+RETRYABLE_STATUS_CODES = {409, 422, 429, 503}
+
+# Approximate JSON characters taken by a vector value, per NumPy dtype
+JSON_CHARACTERS_PER_VALUE = {"int8": 4, "float16": 9, "float32": 20}
+
+class FileUploader:
+    def __init__(self, service_endpoint, index_name, api_key, on_uploaded=None,
+                 max_batch_documents=500, max_batch_bytes=8 * 1024 * 1024, max_batch_wait=1.0,
+                 max_concurrent_batches=None, max_retries=5, limiter=None,
+                 metrics=None):
+        # Initialize the async SearchClient
+        self.search_client = SearchClient(
+            endpoint=service_endpoint,
+            index_name=index_name,
+            credential=AzureKeyCredential(api_key),
+            raw_response_hook=lambda response: self.limiter.observe_response(response),
+        )
+
+        # Optional callback invoked with every successfully uploaded document
+        self.on_uploaded = on_uploaded
+
+        # Batches are bounded by document count and by payload size, which vectors dominate
+        self.batch_collector = BatchCollector(
+            max_items=max_batch_documents,
+            max_cost=max_batch_bytes,
+            max_wait=max_batch_wait,
+            cost_function=self.estimate_size
+        )
+
+        # Number of batches sent concurrently across all uploader workers, either fixed or driven
+        # by an adaptive controller. Each worker sends one batch at a time, so the number of
+        # workers is the upper bound, which the indexer passes as the fixed limit
+        self.limiter = limiter or ConcurrencyController(max_concurrent_batches)
+        self.max_retries = max_retries
+        self.metrics = metrics or PipelineMetrics()
+
+        # Throughput counters
+        self.documents_uploaded = 0
+        self.documents_failed = 0
+        self.bytes_uploaded = 0
+        self.first_upload_time = None
+
+    @staticmethod
+    def estimate_size(document):
+        # Approximate JSON payload size without serializing the document twice
+        size = 2
+        for key, value in document.items():
+            size += len(key) + 4
+            if isinstance(value, str):
+                size += len(value) + 2
+            elif isinstance(value, np.ndarray):
+                size += JSON_CHARACTERS_PER_VALUE.get(value.dtype.name, 20) * len(value)
+            elif isinstance(value, (list, tuple)):
+                # A float value takes about 20 characters in JSON, an int8 one about 4
+                size += (4 if value and isinstance(value[0], int) else 20) * len(value)
+            else:
+                size += 20
+        return size
+
+    @staticmethod
+    def vector_to_list(vector):
+        # NumPy vectors are serialized as JSON lists. Half precision values are rounded to the
+        # digits they hold instead of being written as their exact binary expansion
+        if not isinstance(vector, np.ndarray):
+            return vector
+        if vector.dtype == np.float16:
+            return np.round(vector.astype(np.float64), 5).tolist()
+        return vector.tolist()
+
+    @staticmethod
+    def prepare_document(document):
+        # Prepare the document for indexing
+        index_document = {
+            "parent_id": document["parent_id"],
+            "chunk_id": document["chunk_id"],
+            "title": document.get("title", ""),
+            "chunk": document.get("chunk", ""),
+            "text_vector": FileUploader.vector_to_list(document.get("text_vector")),
+            "image_vector": FileUploader.vector_to_list(document.get("image_vector")),
+            "page_number": document.get("page_number"),
+            "last_page_number": document.get("last_page_number"),
+            "content_type": document.get("content_type"),
+            "source_link": document.get("source_link"),
+            "canonical_id": document.get("canonical_id"),
+        }
+
+        # Remove fields with None values to prevent indexing errors
+        return {k: v for k, v in index_document.items() if v is not None}
+
+    async def upload_documents(self, vector_queue, worker_id, logger):
+        pending = None
+        done = False
+        while not done:
+            batch, pending, done = await self.batch_collector.collect(vector_queue, pending)
+            if not batch:
+                continue
+
+            try:
+                index_documents = [self.prepare_document(document) for document in batch]
+                await self.send_batch(index_documents, worker_id, logger)
+            except Exception as e:
+                self.documents_failed += len(batch)
+                self.metrics.count("upload", "errors", len(batch))
+                logger.error(f"Uploader {worker_id}: Error uploading batch of {len(batch)} documents: {e}")
+            finally:
+                for _ in batch:
+                    vector_queue.task_done()
+
+    async def send_batch(self, index_documents, worker_id, logger):
+        # Upload the batch, then re-send only the documents that failed with a retryable status
+        if self.first_upload_time is None:
+            self.first_upload_time = time.time()
+
+        for attempt in range(self.max_retries + 1):
+            documents_by_key = {document["chunk_id"]: document for document in index_documents}
+            retry_documents = []
+
+            async with self.limiter.slot():
+                start_time = time.time()
+                try:
+                    results = await self.search_client.upload_documents(documents=index_documents)
+                except HttpResponseError as e:
+                    if e.status_code not in RETRYABLE_STATUS_CODES:
+                        raise
+                    # The whole request was rejected. The response hook already counted every
+                    # throttled attempt of the client, only clients without it are counted here
+                    if e.status_code in THROTTLING_STATUS_CODES and not self.limiter.observes_responses:
+                        self.limiter.record_throttle()
+                    results = []
+                    retry_documents = index_documents
+                self.metrics.observe(
+                    "upload", time.time() - start_time, items=len(index_documents),
+                    bytes=sum(self.estimate_size(document) for document in index_documents)
+                )
+
+            for result in results:
+                document = documents_by_key[result.key]
+                if result.succeeded:
+                    self.documents_uploaded += 1
+                    self.bytes_uploaded += self.estimate_size(document)
+                    if self.on_uploaded is not None:
+                        self.on_uploaded(document)
+                elif result.status_code in RETRYABLE_STATUS_CODES:
+                    retry_documents.append(document)
+                    if result.status_code in THROTTLING_STATUS_CODES:
+                        self.limiter.record_throttle()
+                else:
+                    self.documents_failed += 1
+                    self.metrics.count("upload", "errors")
+                    logger.error(f"Uploader {worker_id}: Failed to index document {result.key} - Error: {result.error_message}")
+
+            if not retry_documents:
+                logger.debug("Uploader %s: Uploaded batch of %d documents", worker_id, len(index_documents))
+                return
+
+            if attempt == self.max_retries:
+                break
+
+            # Exponential backoff with full jitter before re-sending the failed keys
+            backoff = random.uniform(0, min(60, 2 ** attempt))
+            self.metrics.count("upload", "retries", len(retry_documents))
+            logger.warning(f"Uploader {worker_id}: Retrying {len(retry_documents)} documents in {backoff:.2f} seconds")
+            await asyncio.sleep(backoff)
+            index_documents = retry_documents
+
+        self.documents_failed += len(retry_documents)
+        self.metrics.count("upload", "errors", len(retry_documents))
+        logger.error(f"Uploader {worker_id}: Giving up on documents {', '.join(document['chunk_id'] for document in retry_documents)}")
+
+    async def delete_documents(self, chunk_ids, logger):
+        # Remove documents that are no longer produced by their source blob, returns the ids
+        # whose deletion succeeded. Failed batches and keys are logged and left to the caller
+        logger.info(f"Uploader: Deleting {len(chunk_ids)} stale documents")
+        deleted = []
+        for start in range(0, len(chunk_ids), 1000):
+            batch = chunk_ids[start:start + 1000]
+            try:
+                results = await self.search_client.delete_documents(
+                    documents=[{"chunk_id": chunk_id} for chunk_id in batch]
+                )
+            except Exception as e:
+                logger.error(f"Uploader: Failed to delete {len(batch)} stale documents: {e}")
+                continue
+            deleted.extend(result.key for result in results if result.succeeded)
+        if len(deleted) < len(chunk_ids):
+            logger.warning(f"Uploader: {len(chunk_ids) - len(deleted)} stale documents were not deleted, they are retried on the next run")
+        return deleted
+
+    def stats(self):
+        elapsed = time.time() - self.first_upload_time if self.first_upload_time else 0
+        return {
+            "documents_uploaded": self.documents_uploaded,
+            "documents_failed": self.documents_failed,
+            "bytes_uploaded": self.bytes_uploaded,
+            "documents_per_second": self.documents_uploaded / elapsed if elapsed else 0.0,
+            "bytes_per_second": self.bytes_uploaded / elapsed if elapsed else 0.0,
+        }
+
+    async def close(self):
+        await self.search_client.close()
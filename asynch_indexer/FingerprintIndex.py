@@ -0,0 +1,24 @@
+class FingerprintIndex:
+    def __init__(self, max_distance):
+        # 64-bit fingerprints split into max_distance + 1 bands: two fingerprints within
+        # max_distance differing bits are equal on at least one band, so only the entries
+        # sharing a band with the query are compared
+        self.max_distance = max_distance
+        band_count = max_distance + 1
+        width = 64 // band_count
+        self.bands = [(index * width, 64 if index == band_count - 1 else (index + 1) * width) for index in range(band_count)]
+        self.buckets = {}
+
+    def band_keys(self, fingerprint):
+        return [(start, (fingerprint >> start) & ((1 << (end - start)) - 1)) for start, end in self.bands]
+
+    def find(self, fingerprint):
+        for key in self.band_keys(fingerprint):
+            for candidate, item_id in self.buckets.get(key, ()):
+                if bin(candidate ^ fingerprint).count("1") <= self.max_distance:
+                    return item_id
+        return None
+
+    def add(self, fingerprint, item_id):
+        for key in self.band_keys(fingerprint):
+            self.buckets.setdefault(key, []).append((fingerprint, item_id))
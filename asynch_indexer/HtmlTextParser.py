@@ -0,0 +1,59 @@
+import base64
+from html.parser import HTMLParser
+
+# HTML elements that end a paragraph, and the layout role of the headings
+HTML_BLOCK_TAGS = {
+    "p", "div", "br", "li", "dt", "dd", "tr", "td", "th", "caption", "figcaption", "blockquote",
+    "pre", "section", "article", "header", "footer", "nav", "aside", "main", "table", "ul", "ol",
+}
+HTML_HEADING_ROLES = {"title": "title", "h1": "title", "h2": "sectionHeading", "h3": "sectionHeading",
+                      "h4": "sectionHeading", "h5": "sectionHeading", "h6": "sectionHeading"}
+HTML_SKIPPED_TAGS = {"script", "style", "noscript", "template", "svg"}
+
+class HtmlTextParser(HTMLParser):
+    def __init__(self):
+        # Paragraphs of an HTML page as (page_number, text, role) tuples on a single page, and
+        # the bytes of the images inlined as base64 data URLs
+        super().__init__(convert_charrefs=True)
+        self.paragraphs = []
+        self.images = []
+        self.texts = []
+        self.role = None
+        self.skipped_depth = 0
+
+    def flush(self):
+        text = " ".join(" ".join(self.texts).split())
+        if text:
+            self.paragraphs.append((1, text, self.role))
+        self.texts = []
+        self.role = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in HTML_SKIPPED_TAGS:
+            self.skipped_depth += 1
+        elif tag in HTML_HEADING_ROLES:
+            self.flush()
+            self.role = HTML_HEADING_ROLES[tag]
+        elif tag in HTML_BLOCK_TAGS:
+            self.flush()
+        elif tag == "img":
+            source = dict(attrs).get("src") or ""
+            if source.startswith("data:image/") and ";base64," in source:
+                try:
+                    self.images.append(base64.b64decode(source.split(",", 1)[1]))
+                except ValueError:
+                    pass
+
+    def handle_endtag(self, tag):
+        if tag in HTML_SKIPPED_TAGS:
+            self.skipped_depth = max(self.skipped_depth - 1, 0)
+        elif tag in HTML_HEADING_ROLES or tag in HTML_BLOCK_TAGS:
+            self.flush()
+
+    def handle_data(self, data):
+        if not self.skipped_depth:
+            self.texts.append(data)
+
+    def close(self):
+        super().close()
+        self.flush()
@@ -1,21 +1,43 @@
-import asyncio  
-import uuid  
 import base64  
-import io  
-from PIL import Image  
-from azure.ai.inference import ImageEmbeddingsClient  
+import numpy as np
+from azure.ai.inference.aio import ImageEmbeddingsClient  
 from azure.ai.inference.models import EmbeddingInput
 from azure.core.credentials import AzureKeyCredential  
+from .ConcurrencyController import ConcurrencyController  
+from .PipelineMetrics import PipelineMetrics  
+
+# Leading bytes of the image formats sent to the image embedding model, with their media type
+IMAGE_SIGNATURES = (
+    (b"\x89PNG", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF8", "image/gif"),
+    (b"RIFF", "image/webp"),
+)
   
 class ImageEmbedder:  
-    def __init__(self, ai_foundry_endpoint, ai_foundry_key,image_embedding_model):  
+    def __init__(self, ai_foundry_endpoint, ai_foundry_key,image_embedding_model, cache=None, limiter=None, metrics=None, journal=None,  
+                 vector_processor=None):  
   
-        # Initialize the EmbeddingsClient for Coheremebed  
+        # Initialize the async EmbeddingsClient for Coheremebed  
         self.embeddings_client = ImageEmbeddingsClient(  
                     endpoint=ai_foundry_endpoint,  
                     credential=AzureKeyCredential(ai_foundry_key),  
-                    model=image_embedding_model
+                    model=image_embedding_model,
+                    raw_response_hook=lambda response: self.limiter.observe_response(response)
         )  
+        self.model = image_embedding_model
+
+        # Optional EmbeddingCache, unchanged figures are served from it instead of the model
+        self.cache = cache
+
+        # Limits the number of concurrent embedding calls, unlimited by default
+        self.limiter = limiter or ConcurrencyController()
+        self.metrics = metrics or PipelineMetrics()
+        self.journal = journal
+
+        # Optional VectorProcessor reducing and quantizing the vectors before upload,
+        # the cache keeps the full vectors
+        self.vector_processor = vector_processor
   
     async def embed_images(self,image_queue,uploader_queue,worker_id, logger):  
         while True:  
@@ -24,49 +46,70 @@ class ImageEmbedder:
                 image_queue.task_done()  
                 break  
   
-            blob_name, blob_uri, image_data, parent_id, page_number = image_info  
-            image_id = str(uuid.uuid4())  
+            blob_name, blob_uri, image_data, parent_id, page_number, image_id, canonical_id = image_info  
   
             try:  
-                logger.info(f"ImageEmbedder {worker_id}:Embedding image {image_id} from document {blob_name} page {page_number}")  
+                # Per-image messages are debug level and lazily formatted, they are on the hot path  
+                logger.debug("ImageEmbedder %s: Embedding image %s from document %s page %s", worker_id, image_id, blob_name, page_number)  
   
-                # Convert image data to base64 encoded data URL  
-                image_base64 = self.convert_to_base64_data_url(image_data)  
-
+                # Look the figure up in the cache before calling the model. Near-duplicates  
+                # linked to a canonical figure are indexed without a vector  
+                cache_key = None
+                vector = None
+                if self.cache is not None and canonical_id is None:
+                    cache_key = self.cache.make_key(self.model, image_data)
+                    vector = self.cache.get_many([cache_key]).get(cache_key)
 
-                # Generate embeddings using Coheremebed  
-                response = self.embeddings_client.embed(  
-                    input=[EmbeddingInput(image=image_base64)]  
-                ) 
+                response = None
+                if vector is None and canonical_id is None:
+                    # Image data is already the base64 encoded data URL produced by the reader  
+                    with self.metrics.track("image_embed") as observation:
+                        observation["bytes"] = len(image_data)
+                        async with self.limiter.slot():
+                            response = await self.embeddings_client.embed(  
+                                input=[EmbeddingInput(image=image_data)]  
+                            ) 
+                    vector = np.asarray(response.data[0].embedding, dtype=np.float32)
+                    if self.cache is not None:
+                        self.cache.put_many([(cache_key, vector)])
+                if vector is not None and self.vector_processor is not None:
+                    vector = self.vector_processor.process(vector[None])[0]
                 
                 # Create document for indexing  
                 document = {  
                     "parent_id": parent_id,  
                     "chunk_id": image_id,  
                     "title": blob_name,  
-                    "image_vector": response.data[0].embedding,  
+                    "image_vector": vector,  
                     "page_number": page_number ,
                     "content_type": "image",  
                     "source_link": blob_uri,   
+                    "canonical_id": canonical_id,
                 }  
                 
                 # Add to uploader queue  
                 await uploader_queue.put(document)  
-                logger.info(f"ImageEmbedder {worker_id}: Successfully processed image {image_id} using model {response.model}. Token consumption {response.usage}")  
+                if self.journal is not None:
+                    self.journal.record_embedded(blob_name)
+                if canonical_id is not None:
+                    logger.debug("ImageEmbedder %s: Linked image %s to its near-duplicate %s", worker_id, image_id, canonical_id)
+                elif response is None:
+                    logger.debug("ImageEmbedder %s: Successfully processed image %s from the embedding cache", worker_id, image_id)  
+                else:
+                    logger.debug("ImageEmbedder %s: Successfully processed image %s using model %s. Token consumption %s", worker_id, image_id, response.model, response.usage)  
   
             except Exception as e:  
                 logger.error(f"ImageEmbedder {worker_id}: Error processing image {image_id}: {e}")  
             finally:  
                 image_queue.task_done()  
   
-    def convert_to_base64_data_url(self, image_data):  
-        # Open the image from bytes  
-        image = Image.open(io.BytesIO(image_data))  
-        # Save the image to a bytes buffer in PNG format  
-        buffered = io.BytesIO()  
-        image.save(buffered, format="PNG")  
-        # Get the base64 encoded string  
-        img_str = base64.b64encode(buffered.getvalue()).decode('utf-8')  
-        # Create the base64 data URL  
-        data_url = f"data:image/png;base64,{img_str}"  
-        return data_url  
\ No newline at end of file
+    async def close(self):
+        await self.embeddings_client.close()
+
+    @staticmethod
+    def convert_to_base64_data_url(image_data):  
+        # Raw image bytes are encoded as they are, without decoding and re-encoding the image.  
+        # The media type is read from the leading bytes, PNG by default  
+        media_type = next((media for signature, media in IMAGE_SIGNATURES if image_data.startswith(signature)), "image/png")
+        img_str = base64.b64encode(image_data).decode('utf-8')  
+        return f"data:{media_type};base64,{img_str}"  
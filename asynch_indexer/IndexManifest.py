@@ -0,0 +1,169 @@
+import json
+import sqlite3
+import uuid
+
+
+class IndexManifest:
+    def __init__(self, manifest_path):
+        # Local record of the blobs indexed by previous runs and of the chunk ids they produced
+        self.connection = sqlite3.connect(manifest_path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS blobs ("
+            "name TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, content_hash TEXT, "
+            "chunk_ids TEXT NOT NULL)"
+        )
+        # Chunk ids to delete from the index, kept until the index confirmed their deletion
+        self.connection.execute("CREATE TABLE IF NOT EXISTS stale_chunks (chunk_id TEXT PRIMARY KEY)")
+        self.connection.commit()
+
+        # Blobs enqueued during the current run, the chunk ids uploaded for them and the number
+        # of chunks and figures their reader and chunker produced
+        self.pending = {}
+
+    @staticmethod
+    def make_parent_id(blob_uri):
+        # Stable across runs so that re-indexing a blob overwrites its previous documents
+        return str(uuid.uuid5(uuid.NAMESPACE_URL, blob_uri))
+
+    @staticmethod
+    def make_chunk_id(parent_id, content_type, page_number, position):
+        # Derived from the document and the position of the chunk or figure inside it
+        return str(uuid.uuid5(uuid.UUID(parent_id), f"{content_type}/{page_number}/{position}"))
+
+    @staticmethod
+    def describe_blob(blob):
+        # Change-detection fields of a listed blob
+        content_md5 = blob.content_settings.content_md5 if blob.content_settings else None
+        return {
+            "etag": blob.etag,
+            "last_modified": blob.last_modified.isoformat() if blob.last_modified else None,
+            "content_hash": bytes(content_md5).hex() if content_md5 else None,
+        }
+
+    def has_changed(self, blob):
+        row = self.connection.execute(
+            "SELECT etag, content_hash FROM blobs WHERE name = ?", (blob.name,)
+        ).fetchone()
+        if row is None:
+            return True
+
+        etag, content_hash = row
+        description = self.describe_blob(blob)
+        if description["etag"] == etag:
+            return False
+        # A rewritten blob gets a new ETag, skip it anyway when its content is identical
+        return description["content_hash"] is None or description["content_hash"] != content_hash
+
+    def mark_pending(self, blob):
+        self.pending[blob.name] = {
+            **self.describe_blob(blob),
+            "chunk_ids": set(),
+            "texts": None,
+            "texts_chunked": 0,
+            "expected": 0,
+        }
+
+    def start_tracking(self, blob_name, text_count, image_count):
+        # Called once the blob was read, like IndexingJournal.start_tracking image_count excludes
+        # skipped duplicates
+        entry = self.pending.get(blob_name)
+        if entry is not None:
+            entry["texts"] = text_count
+            entry["expected"] += image_count
+
+    def record_chunked(self, blob_name, chunk_count):
+        entry = self.pending.get(blob_name)
+        if entry is not None:
+            entry["texts_chunked"] += 1
+            entry["expected"] += chunk_count
+
+    def record_uploaded_blob(self, blob_name, chunk_ids):
+        # A blob uploaded by an interrupted run and skipped by the resumed one, complete with the
+        # chunk ids the journal kept for it
+        entry = self.pending.get(blob_name)
+        if entry is not None:
+            entry["chunk_ids"].update(chunk_ids)
+            entry["texts"] = 0
+            entry["expected"] = len(entry["chunk_ids"])
+
+    def record_chunk(self, document):
+        # Called for every document accepted by the index
+        entry = self.pending.get(document.get("title"))
+        if entry is not None:
+            entry["chunk_ids"].add(document["chunk_id"])
+
+    @staticmethod
+    def is_complete(entry):
+        # Every chunk and figure produced for the blob made it to the index. A blob whose items
+        # were all skipped as duplicates is complete with no chunk ids
+        return (entry["texts"] is not None and entry["texts_chunked"] >= entry["texts"]
+                and len(entry["chunk_ids"]) >= entry["expected"])
+
+    def finish_run(self, listed_blob_names):
+        # Persist the processed blobs and return the chunk ids that are no longer produced,
+        # either because their blob was removed or because the document shrank, with the ones
+        # whose deletion failed in previous runs. They stay in the manifest until record_deleted
+        stale_chunk_ids = []
+
+        for name, entry in self.pending.items():
+            row = self.connection.execute(
+                "SELECT chunk_ids FROM blobs WHERE name = ?", (name,)
+            ).fetchone()
+            previous_chunk_ids = set(json.loads(row[0])) if row is not None else set()
+            if not self.is_complete(entry):
+                # Some items failed: keep the previous version of the blob so that the next run
+                # retries it and nothing is deleted, and only add the chunk ids uploaded by this
+                # run so that they are cleaned up later. A new blob gets no version at all
+                if entry["chunk_ids"] - previous_chunk_ids:
+                    chunk_ids = json.dumps(sorted(previous_chunk_ids | entry["chunk_ids"]))
+                    if row is not None:
+                        self.connection.execute("UPDATE blobs SET chunk_ids = ? WHERE name = ?", (chunk_ids, name))
+                    else:
+                        self.connection.execute(
+                            "INSERT INTO blobs (name, etag, last_modified, content_hash, chunk_ids) "
+                            "VALUES (?, NULL, NULL, NULL, ?)", (name, chunk_ids)
+                        )
+                continue
+            stale_chunk_ids.extend(previous_chunk_ids - entry["chunk_ids"])
+            self.connection.execute(
+                "INSERT OR REPLACE INTO blobs (name, etag, last_modified, content_hash, chunk_ids) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (name, entry["etag"], entry["last_modified"], entry["content_hash"],
+                 json.dumps(sorted(entry["chunk_ids"])))
+            )
+
+        live_chunk_ids = set()
+        rows = self.connection.execute("SELECT name, chunk_ids FROM blobs").fetchall()
+        for name, chunk_ids in rows:
+            if name not in listed_blob_names:
+                stale_chunk_ids.extend(json.loads(chunk_ids))
+                self.connection.execute("DELETE FROM blobs WHERE name = ?", (name,))
+            else:
+                live_chunk_ids.update(json.loads(chunk_ids))
+
+        self.connection.executemany(
+            "INSERT OR IGNORE INTO stale_chunks (chunk_id) VALUES (?)",
+            [(chunk_id,) for chunk_id in stale_chunk_ids]
+        )
+        # A blob added back under the same name produces the same ids again, they are not stale anymore
+        stale_chunk_ids = [
+            chunk_id for chunk_id, in self.connection.execute("SELECT chunk_id FROM stale_chunks").fetchall()
+            if chunk_id not in live_chunk_ids
+        ]
+        self.connection.executemany(
+            "DELETE FROM stale_chunks WHERE chunk_id = ?",
+            [(chunk_id,) for chunk_id in live_chunk_ids]
+        )
+        self.connection.commit()
+        self.pending = {}
+        return stale_chunk_ids
+
+    def record_deleted(self, chunk_ids):
+        # Forget the stale chunk ids the index confirmed as deleted
+        self.connection.executemany(
+            "DELETE FROM stale_chunks WHERE chunk_id = ?", [(chunk_id,) for chunk_id in chunk_ids]
+        )
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
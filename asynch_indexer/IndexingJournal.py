@@ -0,0 +1,180 @@
+import base64
+import json
+import sqlite3
+import time
+import zlib
+from .ImageEmbedder import ImageEmbedder
+
+# Stages a document goes through, in order
+STAGES = ("analyzed", "chunked", "embedded", "uploaded")
+
+class IndexingJournal:
+    def __init__(self, journal_path, owns_embeddings=False):
+        # Write-ahead record of the progress of an indexing run, so that a crashed or killed run
+        # can be resumed: uploaded blobs are skipped and the others restart from their stored
+        # analysis instead of calling Document Intelligence and rendering figures again
+        self.connection = sqlite3.connect(journal_path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "name TEXT PRIMARY KEY, etag TEXT, stage TEXT NOT NULL, pages BLOB, updated_at REAL NOT NULL, "
+            "chunk_ids TEXT)"
+        )
+        # Journals written before the chunk ids of the uploaded documents were kept
+        if "chunk_ids" not in {column[1] for column in self.connection.execute("PRAGMA table_info(documents)")}:
+            self.connection.execute("ALTER TABLE documents ADD COLUMN chunk_ids TEXT")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS figures ("
+            "name TEXT NOT NULL, position INTEGER NOT NULL, page_number INTEGER NOT NULL, "
+            "image_id TEXT NOT NULL, image BLOB NOT NULL, PRIMARY KEY (name, position))"
+        )
+        self.connection.commit()
+
+        # The vectors of the run are kept in the journal file when no other embedding cache is
+        # configured, they are then forgotten with the journal
+        self.owns_embeddings = owns_embeddings
+
+        # In-memory progress counters of the documents of the current run
+        self.progress = {}
+
+    def get_uploaded_chunk_ids(self, blob):
+        # Ids of the documents uploaded for the blob, None when they are unknown
+        row = self.connection.execute(
+            "SELECT chunk_ids FROM documents WHERE name = ? AND etag = ? AND stage = 'uploaded'",
+            (blob.name, blob.etag)
+        ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+    def get_stage(self, blob):
+        # Last completed stage of the blob, None when it has to be processed from scratch
+        row = self.connection.execute(
+            "SELECT etag, stage FROM documents WHERE name = ?", (blob.name,)
+        ).fetchone()
+        if row is None or row[0] != blob.etag:
+            return None
+        return row[1]
+
+    def set_stage(self, name, stage, chunk_ids=None):
+        self.connection.execute(
+            "UPDATE documents SET stage = ?, updated_at = ? WHERE name = ?", (stage, time.time(), name)
+        )
+        if stage == "uploaded":
+            # The stored analysis is not needed anymore once the document is in the index, the ids
+            # of its documents are kept for the manifest of a resumed run
+            self.connection.execute(
+                "UPDATE documents SET pages = NULL, chunk_ids = ? WHERE name = ?",
+                (json.dumps(sorted(chunk_ids or [])), name)
+            )
+            self.connection.execute("DELETE FROM figures WHERE name = ?", (name,))
+        self.connection.commit()
+
+    def record_analyzed(self, blob, paragraphs, images):
+        # Persist the extracted paragraphs and figure payloads, compressed
+        self.connection.execute("DELETE FROM figures WHERE name = ?", (blob.name,))
+        self.connection.execute(
+            "INSERT OR REPLACE INTO documents (name, etag, stage, pages, updated_at) VALUES (?, ?, ?, ?, ?)",
+            (blob.name, blob.etag, "analyzed", zlib.compress(json.dumps(paragraphs).encode('utf-8')), time.time())
+        )
+        self.connection.executemany(
+            "INSERT INTO figures (name, position, page_number, image_id, image) VALUES (?, ?, ?, ?, ?)",
+            [
+                # Data URLs are stored as their raw image bytes
+                (blob.name, position, page_number, image_id, base64.b64decode(image_data.split(",", 1)[1]))
+                for position, (_, _, image_data, _, page_number, image_id) in enumerate(images)
+            ]
+        )
+        self.connection.commit()
+
+    def start_tracking(self, blob_name, text_count, image_count):
+        # Count the items of the document through the following stages of this run. The text of
+        # a document goes through the chunker as a single item, image_count excludes skipped duplicates
+        self.progress[blob_name] = {
+            "texts": text_count,
+            "images": image_count,
+            "texts_chunked": 0,
+            "chunks": 0,
+            "embedded": 0,
+            "uploaded": 0,
+            "chunk_ids": [],
+            "stage": "analyzed",
+        }
+        self.check_progress(blob_name)
+
+    def load_analyzed(self, blob):
+        # Returns ([(page_number, text, role)], [(page_number, image_id, data_url)]) stored for the blob
+        row = self.connection.execute(
+            "SELECT pages FROM documents WHERE name = ? AND etag = ?", (blob.name, blob.etag)
+        ).fetchone()
+        if row is None or row[0] is None:
+            return None
+        paragraphs = [tuple(paragraph) for paragraph in json.loads(zlib.decompress(row[0]).decode('utf-8'))]
+        figures = [
+            (page_number, image_id, ImageEmbedder.convert_to_base64_data_url(image))
+            for page_number, image_id, image in self.connection.execute(
+                "SELECT page_number, image_id, image FROM figures WHERE name = ? ORDER BY position", (blob.name,)
+            )
+        ]
+        return paragraphs, figures
+
+    def record_chunked(self, blob_name, chunk_count):
+        entry = self.progress.get(blob_name)
+        if entry is not None:
+            entry["texts_chunked"] += 1
+            entry["chunks"] += chunk_count
+            self.check_progress(blob_name)
+
+    def record_embedded(self, blob_name, count=1):
+        entry = self.progress.get(blob_name)
+        if entry is not None:
+            entry["embedded"] += count
+            self.check_progress(blob_name)
+
+    def record_uploaded(self, document):
+        entry = self.progress.get(document.get("title"))
+        if entry is not None:
+            entry["uploaded"] += 1
+            entry["chunk_ids"].append(document["chunk_id"])
+            self.check_progress(document["title"])
+
+    def check_progress(self, blob_name):
+        # Move the document to the next stages once all of its items have passed them
+        entry = self.progress[blob_name]
+        total = entry["chunks"] + entry["images"]
+        completed = {
+            "chunked": entry["texts_chunked"] >= entry["texts"],
+            "embedded": entry["texts_chunked"] >= entry["texts"] and entry["embedded"] >= total,
+            "uploaded": entry["texts_chunked"] >= entry["texts"] and entry["uploaded"] >= total,
+        }
+        stage = entry["stage"]
+        for next_stage in STAGES[STAGES.index(stage) + 1:]:
+            if not completed[next_stage]:
+                break
+            stage = next_stage
+        if stage != entry["stage"]:
+            entry["stage"] = stage
+            self.set_stage(blob_name, stage, entry["chunk_ids"])
+
+    def is_complete(self):
+        # True when every document of the journal has been uploaded
+        row = self.connection.execute(
+            "SELECT COUNT(*) FROM documents WHERE stage != 'uploaded'"
+        ).fetchone()
+        return row[0] == 0
+
+    def clear(self):
+        self.connection.execute("DELETE FROM figures")
+        self.connection.execute("DELETE FROM documents")
+        if self.owns_embeddings and self.connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'embeddings'").fetchone():
+            self.connection.execute("DELETE FROM embeddings")
+        self.connection.commit()
+        self.progress = {}
+
+    def stats(self):
+        counts = dict(self.connection.execute("SELECT stage, COUNT(*) FROM documents GROUP BY stage").fetchall())
+        return {stage: counts.get(stage, 0) for stage in STAGES}
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,165 @@
+import posixpath
+import zipfile
+import xml.etree.ElementTree as ET
+from .FigureExtractor import FigureExtractor
+from .HtmlTextParser import HtmlTextParser
+
+# XML namespaces of the Office Open XML parts
+W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+A = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+P = "{http://schemas.openxmlformats.org/presentationml/2006/main}"
+R = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+RELATIONSHIPS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+class LocalExtractor:
+    # Text and native figures of DOCX, PPTX and HTML documents, read with the standard library.
+    # Paragraphs are (page_number, text, role) tuples like the ones built from Document
+    # Intelligence results, figures are (page_number, data_url) tuples of the embedded images,
+    # which are read from the document as they are instead of rendering and cropping its pages
+
+    @staticmethod
+    def extract(path, kind):
+        # Runs in a worker process
+        if kind == "docx":
+            return LocalExtractor.extract_docx(path)
+        if kind == "pptx":
+            return LocalExtractor.extract_pptx(path)
+        if kind == "html":
+            return LocalExtractor.extract_html(path)
+        raise ValueError(f"No local extractor for {kind} documents")
+
+    @staticmethod
+    def read_relationships(archive, part):
+        # {relationship id: part name} of the internal targets of a part
+        folder, name = posixpath.split(part)
+        rels_part = posixpath.join(folder, "_rels", f"{name}.rels")
+        if rels_part not in archive.namelist():
+            return {}
+        relationships = {}
+        for relationship in ET.fromstring(archive.read(rels_part)).iter(f"{RELATIONSHIPS}Relationship"):
+            if relationship.get("TargetMode") != "External":
+                target = relationship.get("Target")
+                relationships[relationship.get("Id")] = (
+                    target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join(folder, target))
+                )
+        return relationships
+
+    @staticmethod
+    def read_figure(archive, relationships, relationship_id, seen):
+        # Data URL of an embedded image, None for images already read, missing or not decodable
+        target = relationships.get(relationship_id)
+        if target is None or target in seen or target not in archive.namelist():
+            return None
+        seen.add(target)
+        return FigureExtractor.encode_image(archive.read(target))
+
+    @staticmethod
+    def docx_paragraph_text(element):
+        # Text of the runs of a paragraph, text boxes anchored in it are left out
+        texts = []
+        for child in element:
+            if child.tag == f"{W}txbxContent":
+                continue
+            if child.tag == f"{W}t":
+                texts.append(child.text or "")
+            elif child.tag == f"{W}tab":
+                texts.append("\t")
+            elif child.tag in (f"{W}br", f"{W}cr") and child.get(f"{W}type") != "page":
+                texts.append("\n")
+            else:
+                texts.append(LocalExtractor.docx_paragraph_text(child))
+        return "".join(texts)
+
+    @staticmethod
+    def docx_paragraphs(element):
+        # Paragraphs of the body and of its tables, in reading order
+        for child in element:
+            if child.tag == f"{W}p":
+                yield child
+            else:
+                yield from LocalExtractor.docx_paragraphs(child)
+
+    @staticmethod
+    def extract_docx(path):
+        paragraphs, figures, seen = [], [], set()
+        with zipfile.ZipFile(path) as archive:
+            document = ET.fromstring(archive.read("word/document.xml"))
+            relationships = LocalExtractor.read_relationships(archive, "word/document.xml")
+
+            # DOCX files have no pages: the page breaks of the last rendering by Word are used
+            # when the file has them, the manual page breaks otherwise
+            if document.find(f".//{W}lastRenderedPageBreak") is not None:
+                page_breaks = lambda paragraph: len(paragraph.findall(f".//{W}lastRenderedPageBreak"))
+            else:
+                page_breaks = lambda paragraph: sum(
+                    1 for br in paragraph.iter(f"{W}br") if br.get(f"{W}type") == "page")
+
+            page_number = 1
+            for paragraph in LocalExtractor.docx_paragraphs(document.find(f"{W}body")):
+                style = paragraph.find(f"{W}pPr/{W}pStyle")
+                style = style.get(f"{W}val", "") if style is not None else ""
+                role = "title" if style == "Title" else "sectionHeading" if style.startswith("Heading") else None
+                text = LocalExtractor.docx_paragraph_text(paragraph).strip()
+                if text:
+                    paragraphs.append((page_number, text, role))
+                for blip in paragraph.iter(f"{A}blip"):
+                    data_url = LocalExtractor.read_figure(archive, relationships, blip.get(f"{R}embed"), seen)
+                    if data_url is not None:
+                        figures.append((page_number, data_url))
+                page_number += page_breaks(paragraph)
+        return paragraphs, figures
+
+    @staticmethod
+    def extract_pptx(path):
+        # One page per slide, in presentation order. Slide titles are section headings
+        paragraphs, figures, seen = [], [], set()
+        with zipfile.ZipFile(path) as archive:
+            presentation = ET.fromstring(archive.read("ppt/presentation.xml"))
+            slide_parts = LocalExtractor.read_relationships(archive, "ppt/presentation.xml")
+            slide_ids = [slide_id.get(f"{R}id") for slide_id in presentation.iter(f"{P}sldId")]
+
+            for page_number, slide_id in enumerate(slide_ids, start=1):
+                slide_part = slide_parts.get(slide_id)
+                if slide_part is None or slide_part not in archive.namelist():
+                    continue
+                slide = ET.fromstring(archive.read(slide_part))
+                relationships = LocalExtractor.read_relationships(archive, slide_part)
+                for element in slide.iter():
+                    if element.tag == f"{P}sp":
+                        placeholder = element.find(f"{P}nvSpPr/{P}nvPr/{P}ph")
+                        placeholder_type = placeholder.get("type") if placeholder is not None else None
+                        role = {"ctrTitle": "title", "title": "sectionHeading"}.get(placeholder_type)
+                        texts = ["".join(run.text or "" for run in text_paragraph.iter(f"{A}t"))
+                                 for text_paragraph in element.iter(f"{A}p")]
+                        if role is not None:
+                            texts = [" ".join(text for text in texts if text.strip())]
+                        for text in texts:
+                            if text.strip():
+                                paragraphs.append((page_number, text.strip(), role))
+                    elif element.tag == f"{A}tc":
+                        text = " ".join("".join(run.text or "" for run in text_paragraph.iter(f"{A}t"))
+                                        for text_paragraph in element.iter(f"{A}p")).strip()
+                        if text:
+                            paragraphs.append((page_number, text, None))
+                    elif element.tag == f"{A}blip":
+                        data_url = LocalExtractor.read_figure(archive, relationships, element.get(f"{R}embed"), seen)
+                        if data_url is not None:
+                            figures.append((page_number, data_url))
+        return paragraphs, figures
+
+    @staticmethod
+    def extract_html(path):
+        # A single page. Only images inlined as data URLs are figures, linked images would
+        # have to be fetched from their own location
+        with open(path, "rb") as html_file:
+            html = html_file.read().decode("utf-8", errors="replace")
+        parser = HtmlTextParser()
+        parser.feed(html)
+        parser.close()
+        figures = []
+        for image_data in parser.images:
+            data_url = FigureExtractor.encode_image(image_data)
+            if data_url is not None:
+                figures.append((1, data_url))
+        return parser.paragraphs, figures
+
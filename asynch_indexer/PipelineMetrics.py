@@ -0,0 +1,157 @@
+import asyncio
+import bisect
+import json
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Upper bounds (seconds) of the latency histogram buckets
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+class PipelineMetrics:
+    def __init__(self, latency_buckets=DEFAULT_LATENCY_BUCKETS, max_queue_samples=3600):
+        # In-memory metrics of the pipeline stages, cheap enough to always be on.
+        # Nothing is exported unless to_prometheus() or summary() is called.
+        self.latency_buckets = tuple(latency_buckets)
+        self.start_time = time.time()
+
+        self.histograms = {}  # stage -> bucket counts (last one is +Inf)
+        self.latency_sums = {}  # stage -> total seconds observed
+        self.counters = {}  # (stage, name) -> value, e.g. items, bytes, errors, retries
+        self.workers = {}  # stage -> number of workers, to derive idle time
+
+        # (elapsed seconds, {queue: depth}, {stage: cumulative busy seconds}). Busy time is added
+        # when a unit of work completes, the difference between two samples is the work a stage
+        # did in between: a stage whose busy time stops growing while its queue is empty is starved
+        self.queue_samples = deque(maxlen=max_queue_samples)
+        self.max_queue_depths = {}
+
+    @contextmanager
+    def track(self, stage):
+        # Time a unit of work of a stage. The yielded dict can be filled with the
+        # number of "items" and "bytes" processed, errors are counted automatically.
+        observation = {"items": 1, "bytes": 0}
+        start_time = time.perf_counter()
+        try:
+            yield observation
+        except Exception:
+            self.count(stage, "errors")
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - start_time, observation["items"], observation["bytes"])
+
+    def observe(self, stage, latency, items=1, bytes=0):
+        if stage not in self.histograms:
+            self.histograms[stage] = [0] * (len(self.latency_buckets) + 1)
+            self.latency_sums[stage] = 0.0
+        self.histograms[stage][bisect.bisect_left(self.latency_buckets, latency)] += 1
+        self.latency_sums[stage] += latency
+        self.count(stage, "items", items)
+        self.count(stage, "bytes", bytes)
+
+    def count(self, stage, name, value=1):
+        self.counters[(stage, name)] = self.counters.get((stage, name), 0) + value
+
+    def set_workers(self, stage, count):
+        self.workers[stage] = count
+
+    def sample_queues(self, queues):
+        depths = {name: queue.qsize() for name, queue in queues.items()}
+        self.queue_samples.append((time.time() - self.start_time, depths, dict(self.latency_sums)))
+        for name, depth in depths.items():
+            self.max_queue_depths[name] = max(depth, self.max_queue_depths.get(name, 0))
+
+    async def sample_queues_periodically(self, queues, interval=1.0):
+        # Runs until cancelled
+        while True:
+            self.sample_queues(queues)
+            await asyncio.sleep(interval)
+
+    def percentile(self, stage, quantile):
+        # Linear interpolation inside the bucket holding the quantile, like Prometheus' histogram_quantile
+        counts = self.histograms.get(stage)
+        if not counts or not sum(counts):
+            return None
+        rank = quantile * sum(counts)
+        cumulative = 0
+        lower_bound = 0.0
+        for upper_bound, count in zip(self.latency_buckets, counts):
+            if count and cumulative + count >= rank:
+                return lower_bound + (upper_bound - lower_bound) * (rank - cumulative) / count
+            cumulative += count
+            lower_bound = upper_bound
+        # The quantile falls in the +Inf bucket, the highest finite bound is the best estimate
+        return self.latency_buckets[-1]
+
+    def summary(self, extra=None):
+        elapsed = time.time() - self.start_time
+        stages = {}
+        for stage in sorted(set(self.histograms) | {stage for stage, _ in self.counters}):
+            calls = sum(self.histograms.get(stage, []))
+            busy = self.latency_sums.get(stage, 0.0)
+            items = self.counters.get((stage, "items"), 0)
+            stages[stage] = {
+                "calls": calls,
+                "items": items,
+                "bytes": self.counters.get((stage, "bytes"), 0),
+                "items_per_second": items / elapsed if elapsed else 0.0,
+                "bytes_per_second": self.counters.get((stage, "bytes"), 0) / elapsed if elapsed else 0.0,
+                "mean_latency": busy / calls if calls else None,
+                "p50_latency": self.percentile(stage, 0.5),
+                "p99_latency": self.percentile(stage, 0.99),
+                "busy_seconds": busy,
+                "errors": self.counters.get((stage, "errors"), 0),
+                "retries": self.counters.get((stage, "retries"), 0),
+            }
+            if stage in self.workers:
+                # Share of the workers' wall time spent outside tracked work (waiting on queues)
+                capacity = self.workers[stage] * elapsed
+                stages[stage]["idle_ratio"] = max(0.0, 1 - busy / capacity) if capacity else None
+
+        summary = {
+            "elapsed_seconds": elapsed,
+            "stages": stages,
+            "max_queue_depths": dict(self.max_queue_depths),
+            "queue_samples": [
+                {"elapsed": elapsed_at, **depths, "busy_seconds": busy}
+                for elapsed_at, depths, busy in self.queue_samples
+            ],
+        }
+        if extra:
+            summary.update(extra)
+        return summary
+
+    def write_summary(self, path, extra=None):
+        with open(path, "w") as summary_file:
+            json.dump(self.summary(extra), summary_file, indent=2)
+
+    def to_prometheus(self, prefix="asynch_indexer"):
+        # Prometheus text exposition format, e.g. for the node exporter textfile collector
+        lines = [
+            f"# HELP {prefix}_stage_latency_seconds Latency of a unit of work of a pipeline stage.",
+            f"# TYPE {prefix}_stage_latency_seconds histogram",
+        ]
+        for stage, counts in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(self.latency_buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f'{prefix}_stage_latency_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'{prefix}_stage_latency_seconds_sum{{stage="{stage}"}} {self.latency_sums[stage]}')
+            lines.append(f'{prefix}_stage_latency_seconds_count{{stage="{stage}"}} {cumulative}')
+
+        lines.append(f"# HELP {prefix}_stage_total Items, bytes, errors and retries counted per stage.")
+        lines.append(f"# TYPE {prefix}_stage_total counter")
+        for (stage, name), value in sorted(self.counters.items()):
+            lines.append(f'{prefix}_stage_total{{stage="{stage}",kind="{name}"}} {value}')
+
+        lines.append(f"# HELP {prefix}_queue_depth Number of items waiting in a stage queue.")
+        lines.append(f"# TYPE {prefix}_queue_depth gauge")
+        if self.queue_samples:
+            for name, depth in sorted(self.queue_samples[-1][1].items()):
+                lines.append(f'{prefix}_queue_depth{{queue="{name}"}} {depth}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, prefix="asynch_indexer"):
+        with open(path, "w") as prometheus_file:
+            prometheus_file.write(self.to_prometheus(prefix))
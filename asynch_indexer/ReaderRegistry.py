@@ -0,0 +1,39 @@
+import os
+
+# Extensions and content types of the formats read by default
+FORMATS = {
+    "pdf": ((".pdf",), ("application/pdf",)),
+    "image": (
+        (".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp", ".tif", ".tiff"),
+        ("image/png", "image/jpeg", "image/gif", "image/webp", "image/bmp", "image/tiff"),
+    ),
+    "docx": ((".docx",), ("application/vnd.openxmlformats-officedocument.wordprocessingml.document",)),
+    "pptx": ((".pptx",), ("application/vnd.openxmlformats-officedocument.presentationml.presentation",)),
+    "html": ((".html", ".htm"), ("text/html",)),
+}
+
+class ReaderRegistry:
+    def __init__(self):
+        # Readers keyed by file extension and by blob content type. A reader is an async callable
+        # (path, blob, blob_uri, parent_id, worker_id, logger) -> (paragraphs, images) called on
+        # the downloaded file, blobs without a reader are not indexed
+        self.by_extension = {}
+        self.by_content_type = {}
+
+    def register(self, reader, extensions=(), content_types=()):
+        # Replaces the reader previously registered for the same extensions and content types
+        for extension in extensions:
+            self.by_extension[extension.lower()] = reader
+        for content_type in content_types:
+            self.by_content_type[content_type.lower()] = reader
+
+    def get(self, blob):
+        # The extension decides, the content type covers the blobs without a known extension
+        extension = os.path.splitext(blob.name)[1].lower()
+        if extension in self.by_extension:
+            return self.by_extension[extension]
+        content_settings = getattr(blob, "content_settings", None)
+        content_type = getattr(content_settings, "content_type", None)
+        if content_type:
+            return self.by_content_type.get(content_type.split(";")[0].strip().lower())
+        return None
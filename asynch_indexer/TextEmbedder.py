@@ -1,55 +1,156 @@
-import uuid  
-import time  
-from tenacity import retry, wait_random_exponential, stop_after_attempt  
-from azure.ai.inference import EmbeddingsClient
+import time
+import numpy as np
+from tenacity import retry, retry_if_exception, wait_random_exponential, stop_after_attempt
+from azure.ai.inference.aio import EmbeddingsClient
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import HttpResponseError
+from .BatchCollector import BatchCollector
+from .ConcurrencyController import ConcurrencyController
+from .PipelineMetrics import PipelineMetrics
 
-  
-class TextEmbedder:  
-    def __init__(self, ai_foundry_endpoint, ai_foundry_key, text_embedding_model)  :    
-
-        self.embeddings_client = EmbeddingsClient(  
-            endpoint=ai_foundry_endpoint,  
-            credential=AzureKeyCredential(ai_foundry_key),  
-            model=text_embedding_model)      
-
-    @retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))  
-    async def generate_embeddings(self, text):  
-        response = self.embeddings_client.embed(  
-             input=[text]
-             )  
-        return response.data[0].embedding
-    
-    async def vectorize_chunks(self, chunk_queue, vector_queue, worker_id, logger):  
-        while True:  
-            data = await chunk_queue.get()  
-            if data is None:  # Sentinel to end the loop  
-                chunk_queue.task_done()  
-                break  
-  
-            blob_name, blob_uri, chunk, parent_id, page_number = data  
-            chunk_id = str(uuid.uuid4())  
-            logger.info(f"TextEmbedder {worker_id}: Embedding chunk {chunk_id} from document {blob_name} page {page_number}")  
-            start_time = time.time()  
-  
-            # Generate embeddings  
-            try:  
-                vector = await self.generate_embeddings(chunk)  
-                vectorization_time = time.time() - start_time  
-                logger.info(f"TextEmbedder {worker_id}: Finished embedding in {vectorization_time:.2f} seconds")  
-  
-                document = {  
-                    "parent_id": parent_id,  
-                    "chunk_id": chunk_id,  
-                    "chunk": chunk,  
-                    "title" : blob_name,
-                    "text_vector": vector,  
-                    "page_number": page_number,  
-                    "content_type": "text",  
-                    "source_link": blob_uri,  
-                }  
-                await vector_queue.put(document)  
-            except Exception as e:  
-                logger.error(f"TextEmbedder {worker_id}: Error embedding chunk {chunk_id}: {e}")  
-            finally:  
-                chunk_queue.task_done()  
\ No newline at end of file
+# Transient failures, retried again once the client's own retries gave up. Other errors are final
+TRANSIENT_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class TextEmbedder:
+    def __init__(self, ai_foundry_endpoint, ai_foundry_key, text_embedding_model,
+                 max_batch_size=96, max_batch_tokens=8000, max_batch_wait=0.05, cache=None, limiter=None,
+                 metrics=None, journal=None, vector_processor=None)  :
+
+        # Async client so that embedding calls and retry backoffs never block the event loop
+        self.embeddings_client = EmbeddingsClient(
+            endpoint=ai_foundry_endpoint,
+            credential=AzureKeyCredential(ai_foundry_key),
+            model=text_embedding_model,
+            raw_response_hook=lambda response: self.limiter.observe_response(response))
+        self.model = text_embedding_model
+
+        # Optional EmbeddingCache, unchanged chunks are served from it instead of the model
+        self.cache = cache
+
+        # Limits the number of concurrent embedding calls, unlimited by default
+        self.limiter = limiter or ConcurrencyController()
+        self.metrics = metrics or PipelineMetrics()
+        self.journal = journal
+
+        # Optional VectorProcessor reducing and quantizing the vectors before upload,
+        # the cache keeps the full vectors
+        self.vector_processor = vector_processor
+
+        # Micro-batches of chunks, bounded by count, approximate token budget and wait time
+        self.batch_collector = BatchCollector(
+            max_items=max_batch_size,
+            max_cost=max_batch_tokens,
+            max_wait=max_batch_wait,
+            cost_function=lambda data: self.estimate_tokens(data[2])
+        )
+
+    @staticmethod
+    def estimate_tokens(text):
+        # Rough estimate (~4 characters per token), good enough to bound the request size
+        return max(1, len(text) // 4)
+
+    @retry(retry=retry_if_exception(lambda e: isinstance(e, HttpResponseError) and e.status_code in TRANSIENT_STATUS_CODES),
+           wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6),
+           before_sleep=lambda retry_state: retry_state.args[0].metrics.count("text_embed", "retries"))
+    async def generate_embeddings(self, texts):
+        async with self.limiter.slot():
+            response = await self.embeddings_client.embed(
+                 input=texts
+                 )
+        # Results carry the index of their input, restore the input order
+        return [np.asarray(item.embedding, dtype=np.float32) for item in sorted(response.data, key=lambda item: item.index)]
+
+    async def generate_embeddings_isolating(self, texts):
+        # A client error (400 for an input the model rejects) fails the whole request: the batch
+        # is bisected so that only the offending texts are lost, their vector is None
+        try:
+            return await self.generate_embeddings(texts)
+        except HttpResponseError as e:
+            if e.status_code is None or not 400 <= e.status_code < 500 or e.status_code in TRANSIENT_STATUS_CODES:
+                raise
+            if len(texts) == 1:
+                return [None]
+            middle = len(texts) // 2
+            return (await self.generate_embeddings_isolating(texts[:middle])
+                    + await self.generate_embeddings_isolating(texts[middle:]))
+
+    async def embed_texts(self, texts):
+        # Vectors in the order of the texts, None for the texts rejected by the model
+        if self.cache is None:
+            return await self.generate_embeddings_isolating(texts)
+
+        # Only send the texts that are not cached yet, once each
+        keys = [self.cache.make_key(self.model, text) for text in texts]
+        vectors_by_key = self.cache.get_many(keys)
+        missing = {key: text for key, text in zip(keys, texts) if key not in vectors_by_key}
+        if missing:
+            new_vectors = await self.generate_embeddings_isolating(list(missing.values()))
+            new_items = list(zip(missing.keys(), new_vectors))
+            self.cache.put_many([(key, vector) for key, vector in new_items if vector is not None])
+            vectors_by_key.update(new_items)
+        return [vectors_by_key[key] for key in keys]
+
+    async def vectorize_chunks(self, chunk_queue, vector_queue, worker_id, logger):
+        pending = None
+        done = False
+        while not done:
+            batch, pending, done = await self.batch_collector.collect(chunk_queue, pending)
+            if not batch:
+                continue
+
+            chunk_ids = [data[5] for data in batch]
+            logger.debug("TextEmbedder %s: Embedding batch of %d chunks", worker_id, len(batch))
+            start_time = time.time()
+
+            # Generate embeddings for the whole batch in a single request. Near-duplicates linked
+            # to a canonical chunk are indexed without a vector
+            to_embed = [data for data in batch if data[7] is None]
+            try:
+                vectors_by_id = {}
+                rejected_ids = set()
+                if to_embed:
+                    vectors = await self.embed_texts([data[2] for data in to_embed])
+                    vectorization_time = time.time() - start_time
+                    self.metrics.observe("text_embed", vectorization_time, items=len(to_embed), bytes=sum(len(data[2]) for data in to_embed))
+                    logger.debug("TextEmbedder %s: Finished embedding %d chunks in %.2f seconds", worker_id, len(to_embed), vectorization_time)
+
+                    # Chunks rejected by the model are dropped, the rest of the batch is indexed
+                    rejected_ids = {data[5] for data, vector in zip(to_embed, vectors) if vector is None}
+                    if rejected_ids:
+                        self.metrics.count("text_embed", "errors", len(rejected_ids))
+                        logger.error(f"TextEmbedder {worker_id}: The model rejected chunks {', '.join(sorted(rejected_ids))}")
+                    embedded = [(data, vector) for data, vector in zip(to_embed, vectors) if vector is not None]
+                    if embedded and self.vector_processor is not None:
+                        processed = self.vector_processor.process(np.stack([vector for _, vector in embedded]))
+                        embedded = [(data, vector) for (data, _), vector in zip(embedded, processed)]
+                    vectors_by_id = {data[5]: vector for data, vector in embedded}
+
+                # Fan the vectors back out to their chunks
+                for blob_name, blob_uri, chunk, parent_id, page_number, chunk_id, last_page_number, canonical_id in batch:
+                    if chunk_id in rejected_ids:
+                        continue
+                    document = {
+                        "parent_id": parent_id,
+                        "chunk_id": chunk_id,
+                        "chunk": chunk,
+                        "title" : blob_name,
+                        "text_vector": vectors_by_id.get(chunk_id),
+                        "page_number": page_number,
+                        "last_page_number": last_page_number,
+                        "content_type": "text",
+                        "source_link": blob_uri,
+                        "canonical_id": canonical_id,
+                    }
+                    await vector_queue.put(document)
+                    if self.journal is not None:
+                        self.journal.record_embedded(blob_name)
+            except Exception as e:
+                self.metrics.count("text_embed", "errors")
+                logger.error(f"TextEmbedder {worker_id}: Error embedding chunks {', '.join(chunk_ids)}: {e}")
+            finally:
+                for _ in batch:
+                    chunk_queue.task_done()
+
+    async def close(self):
+        await self.embeddings_client.close()
@@ -0,0 +1,81 @@
+import numpy as np
+
+# Dimension reductions applied before quantization
+REDUCTIONS = ("truncate", "pca")
+
+# Search index vector field type matching each stored precision
+SEARCH_FIELD_TYPES = {
+    "float32": "Collection(Edm.Single)",
+    "float16": "Collection(Edm.Half)",
+    "int8": "Collection(Edm.SByte)",
+}
+
+class VectorProcessor:
+    def __init__(self, dimensions=None, reduction="truncate", pca_path=None, dtype="float32"):
+        # Optional stage between the embedders and the uploader: reduce the vectors to dimensions
+        # (Matryoshka-style truncation of the leading dimensions, or a PCA projection fitted
+        # offline), L2-normalize them, then store them as float32, float16 or int8.
+        # Normalized vectors are meant for cosine similarity, which int8 quantization relies on:
+        # each vector is scaled independently to use the whole [-127, 127] range.
+        if reduction not in REDUCTIONS:
+            raise ValueError(f"Unknown reduction {reduction}, expected one of {REDUCTIONS}")
+        if dtype not in SEARCH_FIELD_TYPES:
+            raise ValueError(f"Unknown vector dtype {dtype}, expected one of {tuple(SEARCH_FIELD_TYPES)}")
+        self.dimensions = dimensions
+        self.reduction = reduction
+        self.dtype = dtype
+
+        # PCA mean and components (dimensions x original dimensions)
+        self.mean = None
+        self.components = None
+        if reduction == "pca" and pca_path is not None:
+            self.load_pca(pca_path)
+
+    def fit_pca(self, vectors):
+        # Fit the projection on a sample of full vectors, e.g. the embeddings of a pilot run
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.dimensions is None or self.dimensions > min(vectors.shape):
+            raise ValueError(f"PCA needs at most {min(vectors.shape)} dimensions, got {self.dimensions}")
+        self.mean = vectors.mean(axis=0)
+        _, _, right_singular_vectors = np.linalg.svd(vectors - self.mean, full_matrices=False)
+        self.components = right_singular_vectors[:self.dimensions].astype(np.float32)
+
+    def save_pca(self, pca_path):
+        np.savez(pca_path, mean=self.mean, components=self.components)
+
+    def load_pca(self, pca_path):
+        with np.load(pca_path) as pca:
+            self.mean = pca["mean"]
+            self.components = pca["components"]
+        if self.dimensions is None:
+            self.dimensions = self.components.shape[0]
+        elif self.dimensions != self.components.shape[0]:
+            raise ValueError(f"{pca_path} projects to {self.components.shape[0]} dimensions, not {self.dimensions}")
+
+    def reduce(self, vectors):
+        # Rows of float32 vectors reduced and normalized, also used for the query vectors
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.reduction == "pca":
+            if self.components is None:
+                raise ValueError("The PCA projection is not fitted, call fit_pca() or pass pca_path")
+            vectors = (vectors - self.mean) @ self.components.T
+        elif self.dimensions is not None:
+            vectors = vectors[:, :self.dimensions]
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+    def quantize(self, vectors):
+        if self.dtype == "float16":
+            return vectors.astype(np.float16)
+        if self.dtype == "int8":
+            scales = np.abs(vectors).max(axis=1, keepdims=True)
+            return np.round(vectors * (127 / np.where(scales > 0, scales, 1))).astype(np.int8)
+        return vectors.astype(np.float32)
+
+    def process(self, vectors):
+        # Rows of full vectors in, rows of vectors to upload out
+        return self.quantize(self.reduce(vectors))
+
+    def search_field_type(self):
+        # Type of the index field the processed vectors are uploaded to
+        return SEARCH_FIELD_TYPES[self.dtype]
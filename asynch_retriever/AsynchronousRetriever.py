@@ -0,0 +1,155 @@
+import asyncio
+
+import numpy as np
+from azure.ai.inference.aio import EmbeddingsClient, ImageEmbeddingsClient
+from azure.ai.inference.models import EmbeddingInput
+from azure.core.credentials import AzureKeyCredential
+from azure.search.documents.aio import SearchClient
+from azure.search.documents.models import VectorizedQuery
+
+from asynch_indexer.ImageEmbedder import ImageEmbedder
+
+from .EmbeddingBatcher import EmbeddingBatcher
+from .QueryEmbeddingCache import QueryEmbeddingCache
+
+# Fields returned by default, the vectors are left out
+DEFAULT_SELECT = ["chunk_id", "parent_id", "title", "chunk", "page_number", "content_type", "source_link"]
+
+# Vector fields of the index, both live in the shared text/image embedding space
+VECTOR_FIELDS = ("text_vector", "image_vector")
+
+class AsynchronousRetriever:
+    def __init__(self, index_name, search_endpoint, search_api_key,
+                 ai_foundry_endpoint, ai_foundry_key,
+                 text_embedding_model, image_embedding_model,
+                 cache_size=10_000, cache_ttl=3600.0,
+                 max_text_batch_size=16, max_image_batch_size=1, max_batch_wait=0.005,
+                 rrf_k=60, vector_processors=None):
+        # One set of async clients (and of their connection pools) shared by every query
+        self.search_client = SearchClient(
+            endpoint=search_endpoint,
+            index_name=index_name,
+            credential=AzureKeyCredential(search_api_key),
+        )
+        self.text_embeddings_client = EmbeddingsClient(
+            endpoint=ai_foundry_endpoint,
+            credential=AzureKeyCredential(ai_foundry_key),
+            model=text_embedding_model
+        )
+        self.image_embeddings_client = ImageEmbeddingsClient(
+            endpoint=ai_foundry_endpoint,
+            credential=AzureKeyCredential(ai_foundry_key),
+            model=image_embedding_model
+        )
+        self.text_embedding_model = text_embedding_model
+        self.image_embedding_model = image_embedding_model
+
+        # Query vectors of popular queries are served from memory
+        self.cache = QueryEmbeddingCache(cache_size, cache_ttl)
+
+        # Concurrent cache misses are embedded together. The image model takes a single
+        # image per request by default
+        self.text_batcher = EmbeddingBatcher(self.embed_texts, max_text_batch_size, max_batch_wait)
+        self.image_batcher = EmbeddingBatcher(self.embed_images, max_image_batch_size, max_batch_wait)
+
+        # Constant of the reciprocal rank fusion, a document ranked r in a list scores 1 / (rrf_k + r)
+        self.rrf_k = rrf_k
+
+        # Optional {vector field: VectorProcessor} of fields indexed with reduced vectors,
+        # the query vectors searched on them are reduced the same way
+        self.vector_processors = vector_processors or {}
+
+    async def embed_texts(self, texts):
+        response = await self.text_embeddings_client.embed(input=texts)
+        # Results carry the index of their input, restore the input order
+        return [np.asarray(item.embedding, dtype=np.float32) for item in sorted(response.data, key=lambda item: item.index)]
+
+    async def embed_images(self, data_urls):
+        response = await self.image_embeddings_client.embed(input=[EmbeddingInput(image=data_url) for data_url in data_urls])
+        return [np.asarray(item.embedding, dtype=np.float32) for item in sorted(response.data, key=lambda item: item.index)]
+
+    async def get_text_vector(self, text):
+        key = self.cache.make_key(self.text_embedding_model, text)
+        vector = self.cache.get(key)
+        if vector is None:
+            vector = await self.text_batcher.embed(key, text)
+            self.cache.put(key, vector)
+        return vector
+
+    async def get_image_vector(self, image_data):
+        # image_data is the raw bytes of the query image
+        key = self.cache.make_key(self.image_embedding_model, image_data)
+        vector = self.cache.get(key)
+        if vector is None:
+            data_url = ImageEmbedder.convert_to_base64_data_url(image_data)
+            vector = await self.image_batcher.embed(key, data_url)
+            self.cache.put(key, vector)
+        return vector
+
+    async def search_field(self, vector, field, k_nearest_neighbors, filter, select):
+        processor = self.vector_processors.get(field)
+        if processor is not None:
+            vector = processor.reduce(vector[None])[0]
+        vector_query = VectorizedQuery(
+            vector=vector.tolist(),
+            k_nearest_neighbors=k_nearest_neighbors,
+            fields=field,
+        )
+        results = await self.search_client.search(
+            search_text=None,
+            vector_queries=[vector_query],
+            filter=filter,
+            select=select,
+            top=k_nearest_neighbors
+        )
+        return [result async for result in results]
+
+    async def search(self, text=None, image_data=None, top=5, k_nearest_neighbors=None,
+                     fields=VECTOR_FIELDS, filter=None, select=DEFAULT_SELECT):
+        # Embed the text and/or image query, search every vector field with every query vector
+        # in parallel, and fuse the ranked lists with reciprocal rank fusion
+        if text is None and image_data is None:
+            raise ValueError("A text or an image query is needed")
+        k_nearest_neighbors = k_nearest_neighbors or top
+
+        embeddings = []
+        if text is not None:
+            embeddings.append(self.get_text_vector(text))
+        if image_data is not None:
+            embeddings.append(self.get_image_vector(image_data))
+        vectors = await asyncio.gather(*embeddings)
+
+        result_lists = await asyncio.gather(*[
+            self.search_field(vector, field, k_nearest_neighbors, filter, select)
+            for vector in vectors
+            for field in fields
+        ])
+        return self.reciprocal_rank_fusion(result_lists, top)
+
+    def reciprocal_rank_fusion(self, result_lists, top):
+        # Each result keeps the fields of its first occurrence and gets an "@search.rrf_score"
+        scores = {}
+        documents = {}
+        for results in result_lists:
+            for rank, result in enumerate(results, start=1):
+                # Results are matched across lists by their key, chunk_id must be selected to fuse them
+                key = result.get("chunk_id", id(result))
+                scores[key] = scores.get(key, 0.0) + 1 / (self.rrf_k + rank)
+                documents.setdefault(key, result)
+
+        fused = []
+        for key in sorted(scores, key=scores.get, reverse=True)[:top]:
+            fused.append({**documents[key], "@search.rrf_score": scores[key]})
+        return fused
+
+    def stats(self):
+        return {
+            "query_cache": self.cache.stats(),
+            "text_batches": self.text_batcher.stats(),
+            "image_batches": self.image_batcher.stats(),
+        }
+
+    async def close(self):
+        await self.search_client.close()
+        await self.text_embeddings_client.close()
+        await self.image_embeddings_client.close()
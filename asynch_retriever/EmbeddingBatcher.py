@@ -0,0 +1,70 @@
+import asyncio
+
+
+class EmbeddingBatcher:
+    def __init__(self, embed_function, max_batch_size=16, max_wait=0.005):
+        # Coalesces the queries arriving within max_wait seconds into a single call of
+        # embed_function(inputs) -> vectors. Concurrent requests for the same key share one input.
+        self.embed_function = embed_function
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.pending = {}  # key -> future shared by all the waiters of the key
+        self.waiting = []  # (key, input) not sent yet
+        self.flush_task = None
+        self.send_tasks = set()  # Calls in flight, the loop only keeps weak references to tasks
+
+        # Counters
+        self.requests = 0
+        self.calls = 0
+
+    async def embed(self, key, value):
+        self.requests += 1
+        future = self.pending.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[key] = future
+            self.waiting.append((key, value))
+            if len(self.waiting) >= self.max_batch_size:
+                self.send_waiting()
+            elif self.flush_task is None:
+                self.flush_task = asyncio.create_task(self.flush_later())
+        # A cancelled waiter must not cancel the call shared with the others
+        return await asyncio.shield(future)
+
+    async def flush_later(self):
+        await asyncio.sleep(self.max_wait)
+        self.flush_task = None
+        while self.waiting:
+            self.send_waiting()
+
+    def send_waiting(self):
+        batch = self.waiting[:self.max_batch_size]
+        self.waiting = self.waiting[self.max_batch_size:]
+        task = asyncio.create_task(self.send(batch))
+        self.send_tasks.add(task)
+        task.add_done_callback(self.send_tasks.discard)
+
+    async def send(self, batch):
+        self.calls += 1
+        try:
+            vectors = await self.embed_function([value for _, value in batch])
+            # Vectors are matched to the inputs by position, a response of another length
+            # leaves no way to tell which ones are missing
+            if len(vectors) != len(batch):
+                raise ValueError(f"The embedding model returned {len(vectors)} vectors for {len(batch)} inputs")
+        except Exception as e:
+            for key, _ in batch:
+                future = self.pending.pop(key)
+                future.set_exception(e)
+                future.exception()  # Retrieved by the waiters, if any are left
+            return
+        for (key, _), vector in zip(batch, vectors):
+            self.pending.pop(key).set_result(vector)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "calls": self.calls,
+            "requests_per_call": self.requests / self.calls if self.calls else 0.0,
+        }
@@ -0,0 +1,53 @@
+import hashlib
+import re
+import time
+from collections import OrderedDict
+
+
+class QueryEmbeddingCache:
+    def __init__(self, max_entries=10_000, ttl=3600.0):
+        # In-memory LRU cache of query vectors, entries expire ttl seconds after they were stored
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expiry time, vector)
+
+        # Hit/miss counters
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model, content):
+        # Text queries are normalized so that trivial variations share an entry,
+        # images are keyed by a hash of their bytes
+        if isinstance(content, str):
+            content = re.sub(r"\s+", " ", content.strip().lower()).encode('utf-8')
+        digest = hashlib.sha256(model.encode('utf-8'))
+        digest.update(b"\0")
+        digest.update(content)
+        return digest.hexdigest()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, vector):
+        self.entries[key] = (time.monotonic() + self.ttl, vector)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
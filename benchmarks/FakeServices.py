@@ -0,0 +1,321 @@
+import asyncio
+import hashlib
+import random
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+import numpy as np
+from azure.ai.documentintelligence.models import AnalyzeResult
+from azure.core.exceptions import HttpResponseError
+
+WORDS = ("linen cotton denim lace knit relaxed fit oversized classic elegant gown jacket sweater "
+         "pants sleeve collar button pocket wash dry iron size small medium large colour navy ivory").split()
+
+# Status codes retried by the RetryPolicy of the Azure SDK clients
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+def make_error(status_code, message):
+    error = HttpResponseError(message=message)
+    error.status_code = status_code
+    return error
+
+class FakeService:
+    def __init__(self, latency=0.05, jitter=0.2, max_concurrency=None, requests_per_second=None,
+                 error_rate=0.0, throttle_rate=0.0, retry_total=10, retry_backoff_factor=0.8,
+                 retry_backoff_max=120, retry_after=1.0, seed=0):
+        # Latency in seconds (+/- jitter ratio), quotas enforced with 429 responses,
+        # and random 500/429 injection. Failed calls are retried like the RetryPolicy of the
+        # Azure SDK clients does: up to retry_total times, after the Retry-After delay of 429
+        # responses and with exponential backoff otherwise. Every attempt is reported to the
+        # raw_response_hook of the client, an error only surfaces once the retries are exhausted
+        self.latency = latency
+        self.jitter = jitter
+        self.max_concurrency = max_concurrency
+        self.requests_per_second = requests_per_second
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_total = retry_total
+        self.retry_backoff_factor = retry_backoff_factor
+        self.retry_backoff_max = retry_backoff_max
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.recent_requests = []
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+        self.retries = 0
+
+    def admit(self):
+        # Decide the outcome of an attempt, returns its latency or raises
+        with self.lock:
+            self.requests += 1
+            now = time.monotonic()
+            self.recent_requests = [t for t in self.recent_requests if now - t < 1.0]
+            over_rate = self.requests_per_second is not None and len(self.recent_requests) >= self.requests_per_second
+            over_concurrency = self.max_concurrency is not None and self.in_flight >= self.max_concurrency
+            if over_rate or over_concurrency or self.random.random() < self.throttle_rate:
+                self.throttled += 1
+                raise make_error(429, "Too many requests")
+            if self.random.random() < self.error_rate:
+                self.errors += 1
+                raise make_error(500, "Injected failure")
+            self.recent_requests.append(now)
+            self.in_flight += 1
+            return self.latency * (1 + self.random.uniform(-self.jitter, self.jitter))
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def backoff(self, retries):
+        # No wait before the first retry, then backoff_factor * 2 ** retries like azure-core
+        if retries == 0:
+            return 0
+        return min(self.retry_backoff_max, self.retry_backoff_factor * 2 ** retries)
+
+    @staticmethod
+    def report(raw_response_hook, status_code, headers=None):
+        # The hook receives a pipeline response, as from the SDK's CustomHookPolicy
+        if raw_response_hook is not None:
+            raw_response_hook(SimpleNamespace(
+                http_response=SimpleNamespace(status_code=status_code, headers=headers or {})))
+
+    async def call_async(self, raw_response_hook=None):
+        for retries in range(self.retry_total + 1):
+            try:
+                latency = self.admit()
+            except HttpResponseError as e:
+                retry_after = self.retry_after if e.status_code == 429 else None
+                self.report(raw_response_hook, e.status_code,
+                            {"Retry-After": str(retry_after)} if retry_after is not None else None)
+                if e.status_code not in RETRY_STATUS_CODES or retries == self.retry_total:
+                    raise
+                self.retries += 1
+                await asyncio.sleep(retry_after if retry_after is not None else self.backoff(retries))
+                continue
+            try:
+                await asyncio.sleep(latency)
+            finally:
+                self.release()
+            self.report(raw_response_hook, 200)
+            return
+
+    def stats(self):
+        return {"requests": self.requests, "throttled": self.throttled, "errors": self.errors,
+                "retries": self.retries}
+
+
+class FakeContainerClient:
+    def __init__(self, blobs, service=None, account_url="https://benchmark.blob.core.windows.net/corpus"):
+        # blobs is a {name: bytes} dict
+        self.blobs = blobs
+        self.service = service or FakeService(latency=0.01)
+        self.account_url = account_url
+
+    def list_blobs(self):
+        async def generate():
+            for name, data in self.blobs.items():
+                yield SimpleNamespace(
+                    name=name,
+                    etag=hashlib.md5(data).hexdigest(),
+                    last_modified=datetime.now(timezone.utc),
+                    size=len(data),
+                    content_settings=SimpleNamespace(content_md5=bytearray(hashlib.md5(data).digest())),
+                )
+        return generate()
+
+    def get_blob_client(self, blob):
+        name = blob if isinstance(blob, str) else blob.name
+        return FakeBlobClient(self, name)
+
+
+class FakeBlobClient:
+    def __init__(self, container, name):
+        self.container = container
+        self.name = name
+        self.url = f"{container.account_url}/{name}"
+
+    async def download_blob(self, offset=None, length=None, **kwargs):
+        await self.container.service.call_async()
+        data = self.container.blobs[self.name]
+        if offset is not None:
+            data = data[offset:offset + length if length is not None else None]
+        return FakeDownloader(data)
+
+
+class FakeDownloader:
+    def __init__(self, data, chunk_size=4 * 1024 * 1024):
+        self.data = data
+        self.size = len(data)
+        self.chunk_size = chunk_size
+
+    async def readall(self):
+        return self.data
+
+    async def readinto(self, stream):
+        for start in range(0, len(self.data), self.chunk_size):
+            stream.write(self.data[start:start + self.chunk_size])
+        return len(self.data)
+
+    def chunks(self):
+        async def generate():
+            for start in range(0, len(self.data), self.chunk_size):
+                yield self.data[start:start + self.chunk_size]
+        return generate()
+
+
+class FakeDocumentIntelligenceClient:
+    def __init__(self, service=None, lines_per_page=40, words_per_line=12, figures_per_page=1.0, seed=0,
+                 raw_response_hook=None):
+        # Synthetic layout results: the page count is read from the PDF, the content is generated
+        self.service = service or FakeService(latency=1.0)
+        self.raw_response_hook = raw_response_hook
+        self.lines_per_page = lines_per_page
+        self.words_per_line = words_per_line
+        self.figures_per_page = figures_per_page
+        self.seed = seed
+
+    @staticmethod
+    def count_pages(data):
+        return max(1, len(re.findall(rb"/Type\s*/Page(?!s)", bytes(data))))
+
+    async def begin_analyze_document(self, model_id, body, pages=None, **kwargs):
+        # Async like the real client, the poller's result() is awaited
+        data = body if isinstance(body, (bytes, bytearray, memoryview)) else body.read()
+        await self.service.call_async(self.raw_response_hook)
+        result = self.make_result(data, pages)
+
+        async def poll():
+            return result
+        return SimpleNamespace(result=poll)
+
+    def make_result(self, data, page_range=None):
+        # Built in the REST representation, as returned by the service
+        generator = random.Random(hashlib.md5(bytes(data)).hexdigest() + str(self.seed))
+        page_count = self.count_pages(data)
+        page_numbers = range(1, page_count + 1)
+        if page_range:
+            first, _, last = page_range.partition("-")
+            page_numbers = range(int(first), min(int(last or first), page_count) + 1)
+
+        content, pages, paragraphs, figures = "", [], [], []
+        for page_number in page_numbers:
+            lines = []
+            for _ in range(self.lines_per_page):
+                text = " ".join(generator.choice(WORDS) for _ in range(self.words_per_line))
+                lines.append({"content": text, "polygon": [], "spans": [{"offset": len(content), "length": len(text)}]})
+                content += text + "\n"
+            pages.append({"pageNumber": page_number, "unit": "inch", "width": 8.5, "height": 11,
+                          "spans": [], "lines": lines})
+            for start in range(0, len(lines), 8):
+                paragraph = {
+                    "content": " ".join(line["content"] for line in lines[start:start + 8]),
+                    "boundingRegions": [{"pageNumber": page_number, "polygon": []}],
+                    "spans": [],
+                }
+                if start == 0:
+                    paragraph["role"] = "sectionHeading"
+                paragraphs.append(paragraph)
+
+            figure_count = int(self.figures_per_page) + (generator.random() < self.figures_per_page % 1)
+            for index in range(figure_count):
+                top = 1 + 3 * index
+                figures.append({"boundingRegions": [{
+                    "pageNumber": page_number, "polygon": [1, top, 4, top, 4, top + 2.5, 1, top + 2.5]
+                }], "spans": []})
+
+        return AnalyzeResult({"modelId": "prebuilt-layout", "content": content, "pages": pages,
+                              "paragraphs": paragraphs, "figures": figures})
+
+    async def close(self):
+        pass
+
+
+class FakeEmbeddingsClient:
+    def __init__(self, service=None, dimensions=1024, model="fake-embed", raw_response_hook=None):
+        # Async stand-in for the text and image embedding clients, vectors are derived from the input
+        self.service = service or FakeService(latency=0.1)
+        self.raw_response_hook = raw_response_hook
+        self.dimensions = dimensions
+        self.model = model
+
+    def vector(self, value):
+        text = value if isinstance(value, str) else getattr(value, "image", str(value))
+        generator = random.Random(hashlib.md5(text.encode("utf-8")).hexdigest())
+        return [generator.uniform(-1, 1) for _ in range(self.dimensions)]
+
+    async def embed(self, input, **kwargs):
+        await self.service.call_async(self.raw_response_hook)
+        return SimpleNamespace(
+            model=self.model,
+            usage=SimpleNamespace(prompt_tokens=0, total_tokens=0),
+            data=[SimpleNamespace(index=index, embedding=self.vector(value)) for index, value in enumerate(input)],
+        )
+
+    async def close(self):
+        pass
+
+
+class FakeSearchClient:
+    def __init__(self, service=None, item_throttle_rate=0.0, seed=0, raw_response_hook=None):
+        # Async stand-in for the search client, item_throttle_rate injects per-document 429s (HTTP 207)
+        self.service = service or FakeService(latency=0.1)
+        self.raw_response_hook = raw_response_hook
+        self.item_throttle_rate = item_throttle_rate
+        self.random = random.Random(seed)
+        self.documents = {}
+
+    async def upload_documents(self, documents, **kwargs):
+        await self.service.call_async(self.raw_response_hook)
+        results = []
+        for document in documents:
+            if self.random.random() < self.item_throttle_rate:
+                results.append(SimpleNamespace(key=document["chunk_id"], succeeded=False, status_code=429,
+                                               error_message="Throttled"))
+            else:
+                self.documents[document["chunk_id"]] = document
+                results.append(SimpleNamespace(key=document["chunk_id"], succeeded=True, status_code=200,
+                                               error_message=None))
+        return results
+
+    async def search(self, search_text=None, vector_queries=None, filter=None, select=None, top=50, **kwargs):
+        # Exact cosine search over the stored documents, only "field eq 'value'" filters are supported
+        await self.service.call_async(self.raw_response_hook)
+        candidates = list(self.documents.values())
+        if filter:
+            field, value = re.fullmatch(r"\s*(\w+)\s+eq\s+'([^']*)'\s*", filter).groups()
+            candidates = [document for document in candidates if document.get(field) == value]
+
+        scores = {}
+        for vector_query in vector_queries or []:
+            query = np.asarray(vector_query.vector, dtype=np.float32)
+            query /= np.linalg.norm(query) or 1
+            searched = [document for document in candidates if document.get(vector_query.fields) is not None]
+            if not searched:
+                continue
+            vectors = np.asarray([document[vector_query.fields] for document in searched], dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1)
+            for document, score in zip(searched, (vectors @ query) / np.where(norms > 0, norms, 1)):
+                scores[document["chunk_id"]] = max(float(score), scores.get(document["chunk_id"], -1.0))
+
+        async def generate():
+            for chunk_id in sorted(scores, key=scores.get, reverse=True)[:top]:
+                document = self.documents[chunk_id]
+                result = {key: document.get(key) for key in select} if select else dict(document)
+                result["@search.score"] = scores[chunk_id]
+                yield result
+        return generate()
+
+    async def delete_documents(self, documents, **kwargs):
+        await self.service.call_async(self.raw_response_hook)
+        for document in documents:
+            self.documents.pop(document["chunk_id"], None)
+        return [SimpleNamespace(key=document["chunk_id"], succeeded=True, status_code=200) for document in documents]
+
+    async def close(self):
+        pass
@@ -0,0 +1,134 @@
+import os
+import random
+import zipfile
+from io import BytesIO
+from xml.sax.saxutils import escape
+from PIL import Image, ImageDraw
+from .FakeServices import WORDS
+
+SAMPLE_DATA_DIRECTORY = os.path.join(os.path.dirname(__file__), "..", "sample_data", "clothes_products")
+
+# Size in pixels of the figures embedded in the synthetic DOCX documents
+FIGURE_SIZE = (400, 300)
+
+# Parts of a minimal DOCX package, around its document and relationships
+DOCX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Default Extension="png" ContentType="image/png"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '</Types>'
+)
+DOCX_PACKAGE_RELATIONSHIPS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Target="word/document.xml" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument"/>'
+    '</Relationships>'
+)
+DOCX_NAMESPACES = (
+    'xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships" '
+    'xmlns:wp="http://schemas.openxmlformats.org/drawingml/2006/wordprocessingDrawing" '
+    'xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+    'xmlns:pic="http://schemas.openxmlformats.org/drawingml/2006/picture"'
+)
+
+class SyntheticCorpus:
+    def __init__(self, documents=100, pages_per_document=4, page_size=(850, 1100), seed=0):
+        # Image-only PDFs with random shapes, so that every document has distinct bytes
+        self.documents = documents
+        self.pages_per_document = pages_per_document
+        self.page_size = page_size
+        self.seed = seed
+
+    def make_page(self, generator, size=None):
+        size = size or self.page_size
+        page = Image.new("RGB", size, "white")
+        draw = ImageDraw.Draw(page)
+        for _ in range(6):
+            x, y = generator.randrange(size[0] - 200), generator.randrange(size[1] - 200)
+            colour = tuple(generator.randrange(256) for _ in range(3))
+            draw.rectangle((x, y, x + generator.randrange(50, 200), y + generator.randrange(50, 200)), fill=colour)
+        return page
+
+    def make_document(self, index):
+        generator = random.Random(f"{self.seed}/{index}")
+        pages = [self.make_page(generator) for _ in range(self.pages_per_document)]
+        buffer = BytesIO()
+        pages[0].save(buffer, format="PDF", save_all=True, append_images=pages[1:], resolution=100)
+        return buffer.getvalue()
+
+    def blobs(self):
+        # {blob name: PDF bytes}
+        return {f"synthetic/document_{index:06d}.pdf": self.make_document(index) for index in range(self.documents)}
+
+    def make_docx(self, index, figures_per_page):
+        # Pages separated by page breaks, each with a heading, a few paragraphs and about
+        # figures_per_page embedded PNG figures. Their figures are read from the file as they
+        # are, so they are indexed without rendering pages
+        generator = random.Random(f"{self.seed}/{index}")
+        body, figures = [], []
+        for page_number in range(1, self.pages_per_document + 1):
+            if page_number > 1:
+                body.append('<w:p><w:r><w:br w:type="page"/></w:r></w:p>')
+            body.append(f'<w:p><w:pPr><w:pStyle w:val="Heading1"/></w:pPr><w:r><w:t>Section {page_number}</w:t></w:r></w:p>')
+            for _ in range(4):
+                text = " ".join(generator.choice(WORDS) for _ in range(40))
+                body.append(f'<w:p><w:r><w:t>{escape(text)}</w:t></w:r></w:p>')
+
+            figure_count = int(figures_per_page) + (generator.random() < figures_per_page % 1)
+            for _ in range(figure_count):
+                figure_buffer = BytesIO()
+                self.make_page(generator, FIGURE_SIZE).save(figure_buffer, format="PNG")
+                figures.append(figure_buffer.getvalue())
+                number = len(figures)
+                body.append(
+                    f'<w:p><w:r><w:drawing><wp:inline><wp:extent cx="3810000" cy="2857500"/>'
+                    f'<wp:docPr id="{number}" name="Figure {number}"/><a:graphic>'
+                    f'<a:graphicData uri="http://schemas.openxmlformats.org/drawingml/2006/picture"><pic:pic>'
+                    f'<pic:nvPicPr><pic:cNvPr id="{number}" name="image{number}.png"/><pic:cNvPicPr/></pic:nvPicPr>'
+                    f'<pic:blipFill><a:blip r:embed="rId{number}"/></pic:blipFill>'
+                    f'<pic:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="3810000" cy="2857500"/></a:xfrm></pic:spPr>'
+                    f'</pic:pic></a:graphicData></a:graphic></wp:inline></w:drawing></w:r></w:p>'
+                )
+
+        relationships = "".join(
+            f'<Relationship Id="rId{number}" Target="media/image{number}.png" '
+            f'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/image"/>'
+            for number in range(1, len(figures) + 1)
+        )
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr("[Content_Types].xml", DOCX_CONTENT_TYPES)
+            archive.writestr("_rels/.rels", DOCX_PACKAGE_RELATIONSHIPS)
+            archive.writestr("word/document.xml",
+                             f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                             f'<w:document {DOCX_NAMESPACES}><w:body>{"".join(body)}</w:body></w:document>')
+            archive.writestr("word/_rels/document.xml.rels",
+                             f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                             f'<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+                             f'{relationships}</Relationships>')
+            for number, figure in enumerate(figures, start=1):
+                archive.writestr(f"word/media/image{number}.png", figure)
+        return buffer.getvalue()
+
+    def office_blobs(self, figures_per_page=1.0):
+        # {blob name: DOCX bytes}
+        return {f"office/document_{index:06d}.docx": self.make_docx(index, figures_per_page)
+                for index in range(self.documents)}
+
+    @staticmethod
+    def sample_blobs(copies=1, directory=SAMPLE_DATA_DIRECTORY):
+        # The sample catalogue PDFs, optionally repeated under different names
+        blobs = {}
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.endswith(".pdf"):
+                with open(os.path.join(directory, file_name), "rb") as pdf_file:
+                    data = pdf_file.read()
+                for copy in range(copies):
+                    blobs[f"sample/{copy:04d}/{file_name}"] = data
+        return blobs
@@ -0,0 +1,264 @@
+"""Run the asynch_indexer pipeline end to end against local fakes of the Azure services.
+
+Usage (from the repository root):
+
+    python -m benchmarks.run_benchmark --corpus synthetic --documents 200
+    python -m benchmarks.run_benchmark --corpus sample --copies 20 --compare
+    python -m benchmarks.run_benchmark --corpus office --update-baseline
+
+baseline.json keeps one baseline per scenario. Its throughputs are absolute numbers of the
+machine that recorded them, --compare is only meaningful on that machine (or a like one).
+--compare also fails when any document was not indexed, whatever the throughput.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import shutil
+import sys
+import time
+
+from asynch_indexer.AsynchronousIndexer import AsynchronousIndexer
+from .FakeServices import (
+    FakeService, FakeContainerClient, FakeDocumentIntelligenceClient, FakeEmbeddingsClient, FakeSearchClient
+)
+from .SyntheticCorpus import SyntheticCorpus
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+def peak_rss_mb():
+    # Peak resident set size of this process and of its largest child (the figure workers)
+    try:
+        import resource
+    except ImportError:  # Not available on Windows
+        return None, None
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024  # ru_maxrss is in bytes on macOS
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the asynchronous indexing pipeline")
+    parser.add_argument("--corpus", choices=["synthetic", "sample", "office"], default="synthetic",
+                        help="Synthetic PDFs, the sample PDFs, or synthetic DOCX files with embedded figures")
+    parser.add_argument("--documents", type=int, default=100, help="Synthetic documents")
+    parser.add_argument("--pages", type=int, default=4, help="Pages per synthetic document")
+    parser.add_argument("--copies", type=int, default=10, help="Copies of each sample PDF")
+    parser.add_argument("--figures-per-page", type=float, default=1.0)
+    parser.add_argument("--lines-per-page", type=int, default=40)
+    parser.add_argument("--dimensions", type=int, default=1024)
+    parser.add_argument("--blob-latency", type=float, default=0.01)
+    parser.add_argument("--di-latency", type=float, default=0.5)
+    parser.add_argument("--di-concurrency", type=int, default=None, help="Document Intelligence quota, 429 above it")
+    parser.add_argument("--embed-latency", type=float, default=0.1)
+    parser.add_argument("--embed-rps", type=float, default=None, help="Embedding requests per second quota")
+    parser.add_argument("--search-latency", type=float, default=0.1)
+    parser.add_argument("--search-item-throttle-rate", type=float, default=0.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Random 429s on every service")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Random 500s on every service")
+    parser.add_argument("--adaptive", action="store_true", help="Enable adaptive concurrency")
+    parser.add_argument("--cpu-workers", type=int, default=None)
+    parser.add_argument("--deduplication", choices=["skip", "link"], default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the report to this JSON file")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--compare", action="store_true",
+                        help="Fail when slower than the stored baseline or when documents were not indexed")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative throughput regression")
+    parser.add_argument("--update-baseline", action="store_true")
+    return parser.parse_args(argv)
+
+def make_scenario(args):
+    # The parameters that must match for two reports to be comparable
+    scenario = {key: value for key, value in vars(args).items()
+                if key not in ("output", "baseline", "compare", "tolerance", "update_baseline")}
+    # The figures of PDFs are rendered by Poppler, the ones of DOCX files are read as they are
+    if args.corpus != "office" and args.figures_per_page and not (shutil.which("pdftoppm") or os.environ.get("POPPLER_PATH")):
+        logging.warning("Poppler is not available, figures are disabled for this run")
+        scenario["figures_per_page"] = 0.0
+    return scenario
+
+def describe_machine():
+    # Stored with every report, the throughputs only compare across like machines
+    return {
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "poppler": bool(shutil.which("pdftoppm") or os.environ.get("POPPLER_PATH")),
+    }
+
+def build_indexer(scenario, blobs):
+    def service(latency, **kwargs):
+        return FakeService(latency=latency, throttle_rate=scenario["throttle_rate"],
+                           error_rate=scenario["error_rate"], seed=scenario["seed"], **kwargs)
+
+    indexer = AsynchronousIndexer(
+        index_name="benchmark",
+        search_endpoint="https://benchmark.search.windows.net",
+        search_api_key="benchmark",
+        storage_account_name="benchmark",
+        storage_container_name="corpus",
+        ai_foundry_endpoint="https://benchmark.services.ai.azure.com/models",
+        ai_foundry_key="benchmark",
+        text_embedding_model="fake-text-embed",
+        image_embedding_model="fake-image-embed",
+        document_intelligence_endpoint="https://benchmark.cognitiveservices.azure.com",
+        document_intelligence_key="benchmark",
+        cpu_workers=scenario["cpu_workers"],
+        adaptive_concurrency=scenario["adaptive"],
+        deduplication=scenario["deduplication"],
+    )
+
+    # Swap every Azure client for its local fake. The fakes retry like the SDK clients and report
+    # every attempt to the same response hooks, which feed the concurrency limiters
+    indexer.storage_container_client = FakeContainerClient(blobs, service(scenario["blob_latency"]))
+    indexer.file_reader.document_client = FakeDocumentIntelligenceClient(
+        service(scenario["di_latency"], max_concurrency=scenario["di_concurrency"]),
+        lines_per_page=scenario["lines_per_page"],
+        figures_per_page=scenario["figures_per_page"],
+        seed=scenario["seed"],
+        raw_response_hook=lambda response: indexer.file_reader.limiter.observe_response(response),
+    )
+    indexer.text_embedder.embeddings_client = FakeEmbeddingsClient(
+        service(scenario["embed_latency"], requests_per_second=scenario["embed_rps"]),
+        dimensions=scenario["dimensions"],
+        raw_response_hook=lambda response: indexer.text_embedder.limiter.observe_response(response),
+    )
+    indexer.image_embedder.embeddings_client = FakeEmbeddingsClient(
+        service(scenario["embed_latency"], requests_per_second=scenario["embed_rps"]),
+        dimensions=scenario["dimensions"],
+        raw_response_hook=lambda response: indexer.image_embedder.limiter.observe_response(response),
+    )
+    indexer.file_uploader.search_client = FakeSearchClient(
+        service(scenario["search_latency"]),
+        item_throttle_rate=scenario["search_item_throttle_rate"],
+        seed=scenario["seed"],
+        raw_response_hook=lambda response: indexer.file_uploader.limiter.observe_response(response),
+    )
+    return indexer
+
+def make_blobs(scenario):
+    if scenario["corpus"] == "sample":
+        return SyntheticCorpus.sample_blobs(copies=scenario["copies"])
+    corpus = SyntheticCorpus(scenario["documents"], scenario["pages"], seed=scenario["seed"])
+    if scenario["corpus"] == "office":
+        return corpus.office_blobs(scenario["figures_per_page"])
+    return corpus.blobs()
+
+async def run_benchmark(scenario):
+    blobs = make_blobs(scenario)
+    indexer = build_indexer(scenario, blobs)
+    start_time = time.time()
+    await indexer.run_indexing()
+    elapsed = time.time() - start_time
+    await indexer.blob_service_client.close()
+    await indexer.credential.close()
+
+    summary = indexer.metrics.summary()
+    stages = summary["stages"]
+    peak_rss, peak_child_rss = peak_rss_mb()
+
+    # A document counts as indexed once some of its chunks or figures are in the index, the
+    # items lost inside indexed documents show up as stage errors
+    index_documents = indexer.file_uploader.search_client.documents
+    uploaded_documents = len({document["title"] for document in index_documents.values()})
+    return {
+        "scenario": scenario,
+        "expected_documents": len(blobs),
+        "uploaded_documents": uploaded_documents,
+        "failed_documents": len(blobs) - uploaded_documents,
+        "uploaded_chunks": len(index_documents),
+        "elapsed_seconds": elapsed,
+        "documents_per_second": uploaded_documents / elapsed,
+        "chunks_per_second": stages.get("text_embed", {}).get("items", 0) / elapsed,
+        "figures_per_second": stages.get("image_embed", {}).get("items", 0) / elapsed,
+        "services": {
+            "blob": indexer.storage_container_client.service.stats(),
+            "document_intelligence": indexer.file_reader.document_client.service.stats(),
+            "text_embeddings": indexer.text_embedder.embeddings_client.service.stats(),
+            "image_embeddings": indexer.image_embedder.embeddings_client.service.stats(),
+            "search": indexer.file_uploader.search_client.service.stats(),
+        },
+        "concurrency": {stage: limiter.stats() for stage, limiter in indexer.limiters.items()},
+        "stage_latency": {
+            stage: {"p50": values["p50_latency"], "p99": values["p99_latency"], "errors": values["errors"]}
+            for stage, values in stages.items()
+        },
+        "max_queue_depths": summary["max_queue_depths"],
+        "peak_rss_mb": peak_rss,
+        "peak_child_rss_mb": peak_child_rss,
+        "machine": describe_machine(),
+    }
+
+def load_baselines(baseline_path):
+    # A list of reports, older files hold a single report
+    if not os.path.exists(baseline_path):
+        return []
+    with open(baseline_path) as baseline_file:
+        baselines = json.load(baseline_file)
+    return baselines["baselines"] if "baselines" in baselines else [baselines]
+
+def save_baseline(baseline_path, report):
+    # Replace the baseline of the same scenario, keep the others
+    baselines = [baseline for baseline in load_baselines(baseline_path) if baseline["scenario"] != report["scenario"]]
+    with open(baseline_path, "w") as baseline_file:
+        json.dump({"baselines": baselines + [report]}, baseline_file, indent=2)
+
+def find_losses(report):
+    # Documents that never reached the index and items dropped by a stage, a run that loses
+    # work fails however fast it was
+    losses = []
+    if report["failed_documents"]:
+        losses.append(f"{report['failed_documents']} of {report['expected_documents']} documents were not indexed")
+    for stage, values in report["stage_latency"].items():
+        if values["errors"]:
+            losses.append(f"{stage}: {values['errors']} errors")
+    return losses
+
+def compare_to_baseline(report, baselines, tolerance):
+    # Returns the list of regressions, empty when the report is within tolerance of the baseline
+    # of its scenario and lost nothing. A scenario without a baseline is a failure rather than a
+    # silent pass
+    regressions = find_losses(report)
+    baseline = next((baseline for baseline in baselines if baseline["scenario"] == report["scenario"]), None)
+    if baseline is None:
+        return regressions + ["no stored baseline for this scenario, record one with --update-baseline"]
+    if baseline.get("machine") != report["machine"]:
+        logging.warning("The baseline was recorded on another machine, throughputs are absolute and may not compare")
+    for key in ("documents_per_second", "chunks_per_second", "figures_per_second"):
+        if baseline.get(key) and report[key] < baseline[key] * (1 - tolerance):
+            regressions.append(f"{key}: {report[key]:.2f} < baseline {baseline[key]:.2f}")
+    return regressions
+
+def main(argv=None):
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    args = parse_args(argv)
+    scenario = make_scenario(args)
+    report = asyncio.run(run_benchmark(scenario))
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+
+    if args.update_baseline:
+        # A run that lost documents is not a baseline
+        losses = find_losses(report)
+        for loss in losses:
+            logging.error(f"Not recording the baseline: {loss}")
+        if losses:
+            return 1
+        save_baseline(args.baseline, report)
+        return 0
+
+    if args.compare:
+        regressions = compare_to_baseline(report, load_baselines(args.baseline), args.tolerance)
+        for regression in regressions:
+            logging.error(f"Regression: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
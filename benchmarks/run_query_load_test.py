@@ -0,0 +1,145 @@
+"""Load test of the asynch_retriever query path: queries per second and tail latency.
+
+Usage (from the repository root):
+
+    python -m benchmarks.run_query_load_test --concurrency 64 --queries 5000
+    python -m benchmarks.run_query_load_test --live --concurrency 8 --queries 200
+
+By default the embedding models and the search index are local fakes holding --documents
+random documents. With --live the services and index of the .env file are queried instead.
+Queries are drawn from --distinct-queries texts with a Zipf popularity, like a serving path
+where a few popular queries dominate.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+from asynch_retriever.AsynchronousRetriever import AsynchronousRetriever
+from .FakeServices import FakeService, FakeEmbeddingsClient, FakeSearchClient, WORDS
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Load test of the asynchronous retriever")
+    parser.add_argument("--live", action="store_true", help="Query the services configured in .env")
+    parser.add_argument("--index-name", default="asynch-custom-push-products-demo")
+    parser.add_argument("--queries", type=int, default=2000, help="Total queries to send")
+    parser.add_argument("--concurrency", type=int, default=32, help="Queries in flight at once")
+    parser.add_argument("--distinct-queries", type=int, default=500)
+    parser.add_argument("--zipf", type=float, default=1.1, help="Exponent of the query popularity")
+    parser.add_argument("--top", type=int, default=5)
+    parser.add_argument("--text-only", action="store_true", help="Only search the text_vector field")
+    parser.add_argument("--cache-size", type=int, default=10_000)
+    parser.add_argument("--documents", type=int, default=2000, help="Documents of the fake index")
+    parser.add_argument("--dimensions", type=int, default=256, help="Vector dimensions of the fake index")
+    parser.add_argument("--embed-latency", type=float, default=0.05)
+    parser.add_argument("--search-latency", type=float, default=0.03)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the report to this JSON file")
+    return parser.parse_args(argv)
+
+def build_retriever(args):
+    if args.live:
+        from dotenv import load_dotenv
+        load_dotenv(override=True)
+        return AsynchronousRetriever(
+            index_name=args.index_name,
+            search_endpoint=os.environ["AZURE_SEARCH_SERVICE_ENDPOINT"],
+            search_api_key=os.environ["AZURE_SEARCH_API_KEY"],
+            ai_foundry_endpoint=os.environ["AZURE_AI_FOUNDRY_ENDPOINT"],
+            ai_foundry_key=os.environ["AZURE_AI_FOUNDRY_KEY"],
+            text_embedding_model=os.environ["TEXT_EMBEDDING_MODEL"],
+            image_embedding_model=os.environ["IMAGE_EMBEDDING_MODEL"],
+            cache_size=args.cache_size,
+        )
+
+    retriever = AsynchronousRetriever(
+        index_name="benchmark",
+        search_endpoint="https://benchmark.search.windows.net",
+        search_api_key="benchmark",
+        ai_foundry_endpoint="https://benchmark.services.ai.azure.com/models",
+        ai_foundry_key="benchmark",
+        text_embedding_model="fake-text-embed",
+        image_embedding_model="fake-image-embed",
+        cache_size=args.cache_size,
+    )
+
+    # Swap the Azure clients for local fakes and fill the fake index
+    embeddings_client = FakeEmbeddingsClient(FakeService(latency=args.embed_latency, seed=args.seed), dimensions=args.dimensions)
+    retriever.text_embeddings_client = embeddings_client
+    retriever.image_embeddings_client = embeddings_client
+    retriever.search_client = FakeSearchClient(FakeService(latency=args.search_latency, seed=args.seed))
+    generator = np.random.default_rng(args.seed)
+    for index in range(args.documents):
+        content_type = "image" if index % 4 == 0 else "text"
+        retriever.search_client.documents[f"document-{index}"] = {
+            "chunk_id": f"document-{index}",
+            "title": f"document_{index // 10}.pdf",
+            "content_type": content_type,
+            f"{content_type}_vector": generator.standard_normal(args.dimensions).astype(np.float32),
+        }
+    return retriever
+
+def make_queries(args):
+    generator = random.Random(args.seed)
+    distinct = [" ".join(generator.choice(WORDS) for _ in range(generator.randint(2, 5)))
+                for _ in range(args.distinct_queries)]
+    weights = [1 / (rank ** args.zipf) for rank in range(1, len(distinct) + 1)]
+    return generator.choices(distinct, weights=weights, k=args.queries)
+
+async def run_load_test(args):
+    retriever = build_retriever(args)
+    queries = make_queries(args)
+    fields = ("text_vector",) if args.text_only else ("text_vector", "image_vector")
+    latencies = []
+    errors = 0
+    next_query = iter(queries)
+
+    async def client():
+        nonlocal errors
+        for query in next_query:
+            start_time = time.perf_counter()
+            try:
+                await retriever.search(text=query, top=args.top, fields=fields)
+            except Exception:
+                errors += 1
+            latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start_time
+    stats = retriever.stats()
+    await retriever.close()
+
+    latencies = np.array(latencies)
+    return {
+        "queries": len(latencies),
+        "concurrency": args.concurrency,
+        "errors": errors,
+        "elapsed_seconds": elapsed,
+        "queries_per_second": len(latencies) / elapsed,
+        "latency_seconds": {
+            "mean": float(latencies.mean()),
+            "p50": float(np.percentile(latencies, 50)),
+            "p95": float(np.percentile(latencies, 95)),
+            "p99": float(np.percentile(latencies, 99)),
+            "max": float(latencies.max()),
+        },
+        **stats,
+    }
+
+def main(argv=None):
+    args = parse_args(argv)
+    report = asyncio.run(run_load_test(args))
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""Offline recall@k of reduced and quantized vectors against the full vectors.
+
+Usage (from the repository root):
+
+    python -m benchmarks.vector_recall
+    python -m benchmarks.vector_recall --vectors embedding_cache.db --k 10
+
+The vectors come from an EmbeddingCache file of a real run when --vectors is given,
+otherwise from a synthetic set of clustered vectors. A held-out share of them is used as
+queries: the ground truth is their top-k by cosine similarity over the full vectors, and every
+configuration is scored by the share of it found in its own top-k.
+"""
+import argparse
+import json
+import sqlite3
+import sys
+
+import numpy as np
+
+from asynch_indexer.FileUploader import FileUploader
+from asynch_indexer.VectorProcessor import VectorProcessor
+
+# (reduction, dimensions, dtype) compared to the full float32 vectors
+DEFAULT_CONFIGURATIONS = (
+    ("truncate", None, "float16"),
+    ("truncate", None, "int8"),
+    ("truncate", 512, "float32"),
+    ("truncate", 256, "float32"),
+    ("truncate", 256, "int8"),
+    ("pca", 256, "float32"),
+    ("pca", 256, "int8"),
+    ("pca", 128, "int8"),
+)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Recall@k of compressed vectors on held-out queries")
+    parser.add_argument("--vectors", help="EmbeddingCache SQLite file to read the vectors from")
+    parser.add_argument("--count", type=int, default=5000, help="Synthetic vectors")
+    parser.add_argument("--dimensions", type=int, default=1024, help="Dimensions of the synthetic vectors")
+    parser.add_argument("--clusters", type=int, default=200, help="Clusters of the synthetic vectors")
+    parser.add_argument("--query-share", type=float, default=0.1, help="Share of the vectors held out as queries")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the report to this JSON file")
+    return parser.parse_args(argv)
+
+def load_vectors(cache_path):
+    # All the vectors of an EmbeddingCache file, they must share the same dimensions
+    connection = sqlite3.connect(cache_path)
+    rows = connection.execute("SELECT vector FROM embeddings").fetchall()
+    connection.close()
+    vectors = [np.frombuffer(vector, dtype=np.float32) for vector, in rows]
+    dimensions = max(len(vector) for vector in vectors)
+    return np.stack([vector for vector in vectors if len(vector) == dimensions])
+
+def make_vectors(count, dimensions, clusters, seed):
+    # Clustered vectors with a decaying variance across dimensions, so that like Matryoshka
+    # embeddings most of the information sits in the leading dimensions
+    generator = np.random.default_rng(seed)
+    scales = 1 / np.sqrt(np.arange(1, dimensions + 1))
+    centers = generator.standard_normal((clusters, dimensions)) * scales
+    members = generator.integers(clusters, size=count)
+    return (centers[members] + 0.5 * generator.standard_normal((count, dimensions)) * scales).astype(np.float32)
+
+def top_k(queries, documents, k):
+    # Indices of the k most similar documents of each query, by cosine similarity
+    queries = queries / np.linalg.norm(queries, axis=1, keepdims=True)
+    documents = documents / np.maximum(np.linalg.norm(documents, axis=1, keepdims=True), 1e-12)
+    scores = queries @ documents.T
+    return np.argpartition(-scores, k, axis=1)[:, :k]
+
+def evaluate(configuration, corpus, queries, truth, k):
+    reduction, dimensions, dtype = configuration
+    processor = VectorProcessor(dimensions=dimensions, reduction=reduction, dtype=dtype)
+    if reduction == "pca":
+        processor.fit_pca(corpus)
+
+    # Documents are stored processed, queries are only reduced (the service takes float queries)
+    stored = processor.process(corpus)
+    found = top_k(processor.reduce(queries), stored.astype(np.float32), k)
+    recall = np.mean([len(set(row) & set(expected)) / k for row, expected in zip(found, truth)])
+    return {
+        "reduction": reduction,
+        "dimensions": stored.shape[1],
+        "dtype": dtype,
+        "search_field_type": processor.search_field_type(),
+        f"recall_at_{k}": float(recall),
+        "bytes_per_vector": stored[0].nbytes,
+        "json_characters_per_vector": float(np.mean([
+            len(json.dumps(FileUploader.vector_to_list(vector))) for vector in stored[:100]
+        ])),
+    }
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.vectors:
+        vectors = load_vectors(args.vectors)
+    else:
+        vectors = make_vectors(args.count, args.dimensions, args.clusters, args.seed)
+
+    # Hold out the queries, the PCA projections are fitted on the corpus only
+    order = np.random.default_rng(args.seed).permutation(len(vectors))
+    query_count = max(1, int(len(vectors) * args.query_share))
+    queries, corpus = vectors[order[:query_count]], vectors[order[query_count:]]
+    truth = top_k(queries, corpus, args.k)
+
+    baseline = evaluate(("truncate", None, "float32"), corpus, queries, truth, args.k)
+    report = {
+        "vectors": len(vectors),
+        "queries": query_count,
+        "full": baseline,
+        "configurations": [
+            evaluate(configuration, corpus, queries, truth, args.k)
+            for configuration in DEFAULT_CONFIGURATIONS
+            if configuration[1] is None or configuration[1] < vectors.shape[1]
+        ],
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())